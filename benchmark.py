@@ -0,0 +1,475 @@
+"""性能基准测试：用随机生成的模拟成绩数据测量报告生成各环节的耗时
+
+不需要真实的学生数据。测试会在临时目录中按文件名规则（初一上期中成绩.xlsx …）
+生成模拟的学期成绩文件，然后依次测量 加载、建立成绩库、解析模板原型、生成个人报告、
+生成前200名报告 各阶段的耗时、峰值内存和每秒生成的报告数。
+
+用法:
+    python benchmark.py                          # 默认测试100、1000、10000名学生
+    python benchmark.py --students 500 --xls-ratio 0.5 --header-variant suffix
+    python benchmark.py --template-only          # 只比较模板解析方式
+    python benchmark.py --students 300 --verify-xml 50   # 检查xml方式生成的报告与openpyxl方式逐单元格一致
+"""
+import argparse
+import copy
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from main import (GradeSummaryGenerator, GradeBefore200, GradeLoader, SEMESTER_KEYS, GRADE_READERS,
+                  available_readers, read_grade_file, report_filename, setup_logging, timings)
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块
+    resource = None
+
+# 各年级开设的科目
+GRADE_SUBJECTS = {
+    '初一': ['语文', '数学', '英语', '地理', '生物', '历史', '政治'],
+    '初二': ['语文', '数学', '英语', '地理', '生物', '历史', '政治', '物理'],
+    '初三': ['语文', '数学', '英语', '历史', '政治', '物理', '化学'],
+}
+# 满分为120分的科目，其余为100分
+FULL_MARK_120 = {'语文', '数学', '英语'}
+
+# 不同学校导出文件的表头写法
+HEADER_VARIANTS = {
+    'plain': {'subject': '{}', 'school_rank': '校排名', 'class_rank': '班排名', 'total': '总分'},
+    'suffix': {'subject': '{}成绩', 'school_rank': '校名次', 'class_rank': '班级排名', 'total': '总成绩'},
+    'prefix': {'subject': '期中{}', 'school_rank': '校次', 'class_rank': '班名次', 'total': '总分'},
+}
+
+SURNAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈'
+GIVEN_CHARS = '伟芳娜敏静丽强磊军洋勇艳杰涛明超秀霞平刚桂英华玉兰萍鹏辉浩宇轩梓涵欣怡子墨晨阳思雨佳琪雅婷嘉俊'
+
+
+def _time_per_call(func, repeat):
+    """执行func repeat次，返回平均每次耗时（毫秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def make_student_names(count, rng):
+    """生成count个互不相同的中文姓名"""
+    names = set()
+    while len(names) < count:
+        given = ''.join(rng.choice(GIVEN_CHARS) for _ in range(rng.choice([1, 2, 2])))
+        names.add(rng.choice(SURNAMES) + given)
+    return sorted(names)
+
+
+def _write_xls(df, path):
+    """用xlwt写入.xls文件（pandas已不支持写入.xls）"""
+    import xlwt
+
+    book = xlwt.Workbook(encoding='utf-8')
+    sheet = book.add_sheet('Sheet1')
+    for col_idx, col in enumerate(df.columns):
+        sheet.write(0, col_idx, str(col))
+    for row_idx, row in enumerate(df.itertuples(index=False), start=1):
+        for col_idx, value in enumerate(row):
+            if isinstance(value, (np.integer, np.floating)):
+                value = value.item()
+            if not (isinstance(value, float) and np.isnan(value)):
+                sheet.write(row_idx, col_idx, value)
+    book.save(path)
+
+
+def make_synthetic_grades(data_dir, student_count, subjects=None, header_variant='mixed',
+                          xls_ratio=0.0, semesters=SEMESTER_KEYS, class_size=45, absent_rate=0.02, seed=0):
+    """在data_dir中生成模拟的学期成绩文件，返回生成的文件列表
+
+    subjects: 只保留这些科目（默认按年级开设的科目）
+    header_variant: 'plain'、'suffix'、'prefix'，或'mixed'（各学期轮换使用）
+    xls_ratio: 保存为.xls格式的学期比例（需要安装xlwt，否则全部保存为.xlsx）
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    if xls_ratio > 0:
+        try:
+            import xlwt  # noqa: F401
+        except ImportError:
+            print("提示: 未安装xlwt，无法生成.xls文件，全部保存为.xlsx")
+            xls_ratio = 0
+
+    names = np.array(make_student_names(student_count, rng))
+    classes = np.arange(student_count) // class_size + 1
+    # 学生的基础水平，使各学期成绩相关
+    ability = np_rng.normal(0, 1, student_count)
+    variants = list(HEADER_VARIANTS)
+
+    files = []
+    for i, semester in enumerate(semesters):
+        variant = HEADER_VARIANTS[variants[i % len(variants)] if header_variant == 'mixed' else header_variant]
+        semester_subjects = [subject for subject in GRADE_SUBJECTS.get(semester[:2], GRADE_SUBJECTS['初三'])
+                             if subjects is None or subject in subjects]
+
+        present = np_rng.random(student_count) >= absent_rate
+        df = pd.DataFrame({'考号': [f"2024{n:05d}" for n in np.flatnonzero(present)],
+                           '班级': classes[present],
+                           '姓名': names[present]})
+        total = np.zeros(present.sum())
+        for subject in semester_subjects:
+            full_mark = 120 if subject in FULL_MARK_120 else 100
+            scores = full_mark * (0.72 + 0.12 * ability[present] + np_rng.normal(0, 0.08, present.sum()))
+            scores = np.round(np.clip(scores, 0, full_mark) * 2) / 2
+            df[variant['subject'].format(subject)] = scores
+            total += scores
+        df[variant['total']] = total
+        df[variant['school_rank']] = df[variant['total']].rank(ascending=False, method='min').astype(int)
+        df[variant['class_rank']] = df.groupby('班级')[variant['total']].rank(ascending=False, method='min').astype(int)
+        # 学校导出文件中常见的无关列
+        df['备注'] = ''
+        df['联系电话'] = [f"138{n:08d}" for n in np_rng.integers(0, 10 ** 8, len(df))]
+
+        as_xls = i < round(len(semesters) * xls_ratio)
+        path = os.path.join(data_dir, f"{semester}成绩.{'xls' if as_xls else 'xlsx'}")
+        if as_xls:
+            _write_xls(df, path)
+        else:
+            df.to_excel(path, index=False)
+        files.append(path)
+    return files
+
+
+class PhaseRecorder:
+    """记录每个阶段的耗时和峰值内存"""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = {}
+
+    def run(self, name, func, *args, **kwargs):
+        """执行一个阶段并记录结果"""
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.phases[name] = {'seconds': elapsed, 'peak_bytes': peak}
+
+
+def _process_peak_rss():
+    """当前进程的峰值常驻内存（字节），无法获取时返回None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS以字节为单位，Linux以KB为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bench_readers(data_dir, readers=None):
+    """用每种读取方式依次读取全部成绩文件（不使用缓存），返回 {读取方式: {'seconds', 'identical'}}，
+    identical表示读到的DataFrame是否与pandas默认方式完全相同"""
+    files = GradeLoader().list_files(data_dir)
+    expected = {file: read_grade_file(file, 'pandas')[0] for file in files}
+    results = {}
+    for reader in readers or available_readers():
+        seconds = 0.0
+        identical = True
+        for file in files:
+            df, elapsed = read_grade_file(file, reader)
+            seconds += elapsed
+            try:
+                pd.testing.assert_frame_equal(expected[file], df)
+            except AssertionError:
+                identical = False
+        results[reader] = {'seconds': seconds, 'identical': identical}
+    return results
+
+
+def bench_cohort(student_count, template_path, work_dir, max_reports=500, jobs=1, trace_memory=False,
+                 engine='openpyxl', verify_xml=0, reader='auto', **data_options):
+    """对一个模拟年级运行完整流程，返回各阶段结果"""
+    data_dir = os.path.join(work_dir, 'Grade')
+    output_dir = os.path.join(work_dir, '学生成绩报告')
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    make_synthetic_grades(data_dir, student_count, **data_options)
+    data_seconds = time.perf_counter() - start
+
+    recorder = PhaseRecorder(trace_memory)
+    loader = GradeLoader(reader=reader)
+    generator = GradeSummaryGenerator(loader=loader, engine=engine)
+
+    all_data = recorder.run('加载(无缓存)', loader.load_all_grades, data_dir)
+    recorder.run('加载(磁盘缓存)', GradeLoader(reader=reader).load_all_grades, data_dir)
+    store = recorder.run('建立成绩库', generator.get_grade_store, all_data)
+    students = list(store.students)
+    recorder.run('解析模板原型', generator.get_template_prototype, template_path)
+
+    # 学生很多时只生成一部分报告，用于计算每秒报告数
+    sample = students[:max_reports] if max_reports else students
+
+    def create_reports():
+        if jobs > 1:
+            return len(generator._generate_reports_parallel(sample, all_data, template_path, output_dir, jobs))
+        return sum(generator.create_student_report(student, all_data, template_path, output_dir)
+                   for student in sample)
+
+    # 只统计生成个人报告期间每份报告各步骤的耗时
+    timings.drain()
+    success_count = recorder.run('生成个人报告', create_reports)
+    report_stages = {stage.split('/', 1)[1]: entry for stage, entry in timings.summary().items()
+                     if stage.startswith('个人报告/')}
+
+    top200_generator = GradeBefore200(loader=loader)
+    top200_template = os.path.join(work_dir, '前200名.xlsx')
+    top200_generator.create_template_file(top200_template)
+    recorder.run('生成前200名报告', top200_generator.generate_top200_report, data_dir,
+                 top200_template, os.path.join(work_dir, '全校前200名统计.xlsx'))
+
+    report_seconds = recorder.phases['生成个人报告']['seconds']
+    result = {
+        'students': len(students),
+        'data_seconds': data_seconds,
+        'phases': recorder.phases,
+        'reports': success_count,
+        'reports_per_second': success_count / report_seconds if report_seconds else 0,
+        'report_stages': report_stages,
+        'peak_rss': _process_peak_rss(),
+        'reader': loader.reader,
+        'readers': bench_readers(data_dir),
+    }
+    if verify_xml:
+        result['verify_xml'] = compare_render_engines(all_data, template_path, students[:verify_xml],
+                                                      work_dir, loader=loader)
+    return result
+
+
+def _cell_style(cell):
+    """单元格的全部样式，用于比较（openpyxl的样式代理对象之间不能直接比较，需要先复制）"""
+    return (copy.copy(cell.font), copy.copy(cell.border), copy.copy(cell.fill), copy.copy(cell.alignment),
+            cell.number_format, copy.copy(cell.protection))
+
+
+def compare_workbooks(expected_path, actual_path):
+    """逐个单元格比较两个报告文件的值和样式，返回不一致之处的描述列表"""
+    with zipfile.ZipFile(actual_path) as package:
+        broken = package.testzip()
+        if broken:
+            return [f"压缩包中的 {broken} 已损坏"]
+
+    expected = load_workbook(expected_path)
+    actual = load_workbook(actual_path)
+    if expected.sheetnames != actual.sheetnames:
+        return [f"工作表不同: {expected.sheetnames} != {actual.sheetnames}"]
+
+    differences = []
+    for ws_expected, ws_actual in zip(expected.worksheets, actual.worksheets):
+        if ws_expected.dimensions != ws_actual.dimensions:
+            differences.append(f"{ws_expected.title} 的范围不同: {ws_expected.dimensions} != {ws_actual.dimensions}")
+        if {str(r) for r in ws_expected.merged_cells.ranges} != {str(r) for r in ws_actual.merged_cells.ranges}:
+            differences.append(f"{ws_expected.title} 的合并单元格不同")
+        for row_expected, row_actual in zip(ws_expected.iter_rows(), ws_actual.iter_rows()):
+            for cell_expected, cell_actual in zip(row_expected, row_actual):
+                if cell_expected.value != cell_actual.value:
+                    differences.append(f"{ws_expected.title}!{cell_expected.coordinate} 的值不同: "
+                                       f"{cell_expected.value!r} != {cell_actual.value!r}")
+                elif _cell_style(cell_expected) != _cell_style(cell_actual):
+                    differences.append(f"{ws_expected.title}!{cell_expected.coordinate} 的样式不同")
+    return differences
+
+
+def compare_render_engines(all_data, template_path, students, work_dir, loader=None):
+    """用openpyxl和xml两种方式生成同一批报告，逐个单元格比较，返回每份报告的耗时和不一致之处"""
+    output_dirs = {}
+    milliseconds = {}
+    for engine in GradeSummaryGenerator.engines:
+        generator = GradeSummaryGenerator(loader=loader, engine=engine)
+        output_dir = os.path.join(work_dir, f'学生成绩报告_{engine}')
+        os.makedirs(output_dir, exist_ok=True)
+        prototype = generator.get_template_prototype(template_path)
+        generator.get_xml_template(prototype)
+        reports = [generator.build_student_cells(student, all_data, prototype.template_subjects)
+                   for student in students]
+
+        start = time.perf_counter()
+        for report in reports:
+            generator.save_student_report(report, prototype, output_dir)
+        milliseconds[engine] = (time.perf_counter() - start) * 1000 / max(1, len(reports))
+        output_dirs[engine] = output_dir
+
+    differences = {}
+    for student in students:
+        filename = report_filename(student)
+        found = compare_workbooks(os.path.join(output_dirs['openpyxl'], filename),
+                                  os.path.join(output_dirs['xml'], filename))
+        if found:
+            differences[student] = found
+    return {'reports': len(students), 'milliseconds': milliseconds, 'differences': differences}
+
+
+def bench_template(template_path, repeat=50):
+    """比较每份报告重新解析模板与从模板原型复制的耗时"""
+    generator = GradeSummaryGenerator()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        # 优化前：每份报告都重新加载模板并识别科目
+        def load_each_time():
+            wb = load_workbook(template_path)
+            generator._get_template_subjects(wb.active)
+
+        results['模板: 每次重新解析'] = _time_per_call(load_each_time, repeat)
+
+        # 优化后：模板只解析一次，每份报告复制原型
+        start = time.perf_counter()
+        prototype = generator.get_template_prototype(template_path)
+        results['模板: 构建原型(一次)'] = (time.perf_counter() - start) * 1000
+        results['模板: 复制原型'] = _time_per_call(prototype.new_workbook, repeat)
+
+        # 完整的单份报告耗时（无成绩数据，只包含模板、样式和保存）
+        def create_report():
+            generator.create_student_report('样例学生', {}, template_path, output_dir)
+
+        results['单份报告: 优化后'] = _time_per_call(create_report, repeat)
+
+        # XML直写：只替换模板工作表中的单元格
+        generator.engine = 'xml'
+        results['单份报告: XML直写'] = _time_per_call(create_report, repeat)
+        generator.engine = 'openpyxl'
+
+        # 每份报告复制原型后再应用一次样式（样式未预先应用到原型时的做法）
+        new_workbook = prototype.new_workbook
+
+        def style_each_time():
+            wb = new_workbook()
+            generator.apply_styles(wb.active, generator.data_start_row, len(SEMESTER_KEYS))
+            return wb
+
+        prototype.new_workbook = style_each_time
+        results['单份报告: 每份应用样式'] = _time_per_call(create_report, repeat)
+
+        # 让原型退化为每次重新解析模板并应用样式，模拟优化前的行为
+        def reload_workbook():
+            wb = load_workbook(template_path)
+            generator._get_template_subjects(wb.active)
+            generator.apply_styles(wb.active, generator.data_start_row, len(SEMESTER_KEYS))
+            return wb
+
+        prototype.new_workbook = reload_workbook
+        results['单份报告: 优化前'] = _time_per_call(create_report, repeat)
+
+    return results
+
+
+def _format_bytes(size):
+    return '-' if size is None else f"{size / 1024 / 1024:.1f} MB"
+
+
+def print_results(results):
+    """打印模板基准测试结果"""
+    width = max(len(name) for name in results) + 4
+    for name, value in results.items():
+        print(f"{name:<{width}}{value:10.2f} ms")
+
+
+def print_cohort_result(result):
+    """打印一个年级的基准测试结果"""
+    print(f"\n=== {result['students']} 名学生（生成模拟数据 {result['data_seconds']:.1f} 秒，"
+          f"读取方式 {result['reader']}）===")
+    for name, phase in result['phases'].items():
+        print(f"  {name:<16}{phase['seconds']:9.2f} 秒   峰值内存 {_format_bytes(phase['peak_bytes'])}")
+    print(f"  生成 {result['reports']} 份报告，{result['reports_per_second']:.1f} 份/秒，"
+          f"进程峰值内存 {_format_bytes(result['peak_rss'])}")
+    if result['report_stages']:
+        stages = sorted(result['report_stages'].items(), key=lambda item: -item[1]['mean'])
+        print("  每份报告各步骤平均耗时: " + "，".join(f"{stage} {entry['mean'] * 1000:.2f} ms" for stage, entry in stages))
+    for reader, timing in result['readers'].items():
+        note = '' if timing['identical'] else '（结果与pandas不同）'
+        print(f"  读取({reader}){'':<{max(0, 10 - len(reader))}}{timing['seconds']:9.2f} 秒{note}")
+    verify = result.get('verify_xml')
+    if verify:
+        timing = '，'.join(f"{engine} {ms:.1f} ms/份" for engine, ms in verify['milliseconds'].items())
+        if verify['differences']:
+            print(f"  xml方式与openpyxl方式有 {len(verify['differences'])}/{verify['reports']} 份报告不一致（{timing}）:")
+            for student, differences in list(verify['differences'].items())[:5]:
+                print(f"    {student}: {'；'.join(differences[:3])}")
+        else:
+            print(f"  xml方式与openpyxl方式生成的 {verify['reports']} 份报告逐单元格一致（{timing}）")
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="成绩报告生成性能基准测试")
+    parser.add_argument('--students', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="模拟的学生人数，可指定多个（默认 100 1000 10000）")
+    parser.add_argument('--template', default="成绩模板.xlsx", help="个人成绩模板文件")
+    parser.add_argument('--subjects', nargs='+', help="只生成这些科目（默认按年级开设的科目）")
+    parser.add_argument('--header-variant', choices=['mixed'] + list(HEADER_VARIANTS), default='mixed',
+                        help="成绩文件的表头写法（默认各学期轮换）")
+    parser.add_argument('--xls-ratio', type=float, default=0.0,
+                        help="保存为.xls格式的学期比例，0~1（需要安装xlwt）")
+    parser.add_argument('--max-reports', type=int, default=500,
+                        help="每个规模最多生成的个人报告数，用于计算每秒报告数（0表示全部生成）")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="生成个人报告的进程数")
+    parser.add_argument('--reader', choices=['auto'] + list(GRADE_READERS), default='auto',
+                        help="加载阶段使用的读取方式（默认auto）；各读取方式的耗时总会单独列出")
+    parser.add_argument('--engine', choices=GradeSummaryGenerator.engines, default='openpyxl',
+                        help="生成个人报告的方式（默认openpyxl）")
+    parser.add_argument('--verify-xml', type=int, default=0, metavar='N',
+                        help="用两种方式各生成前N名学生的报告，逐单元格检查是否一致并比较耗时")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="用tracemalloc统计每个阶段的峰值内存（会明显增加耗时）")
+    parser.add_argument('--keep', action='store_true', help="保留生成的模拟数据和报告")
+    parser.add_argument('--template-only', action='store_true', help="只比较模板解析方式的耗时")
+    parser.add_argument('--repeat', type=int, default=50, help="模板基准测试的重复次数")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """基准测试入口"""
+    args = parse_args(argv)
+    # 只输出警告，避免日志影响计时
+    setup_logging(logging.WARNING)
+
+    if not os.path.exists(args.template):
+        print(f"模板文件 '{args.template}' 不存在")
+        sys.exit(1)
+
+    if args.template_only:
+        print_results(bench_template(args.template, args.repeat))
+        return
+
+    template_path = os.path.abspath(args.template)
+    for student_count in args.students:
+        work_dir = tempfile.mkdtemp(prefix=f"classgrade_bench_{student_count}_")
+        try:
+            result = bench_cohort(student_count, template_path, work_dir, max_reports=args.max_reports,
+                                  jobs=args.jobs, trace_memory=args.trace_memory,
+                                  engine=args.engine, verify_xml=args.verify_xml, reader=args.reader,
+                                  subjects=args.subjects, header_variant=args.header_variant,
+                                  xls_ratio=args.xls_ratio)
+            print_cohort_result(result)
+        finally:
+            if args.keep:
+                print(f"  模拟数据和报告保存在 {work_dir}")
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
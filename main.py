@@ -1,9 +1,39 @@
 import pandas as pd
+import numpy as np
+from pandas.io.parsers import TextParser
 from openpyxl import load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from openpyxl.cell.cell import Cell, ILLEGAL_CHARACTERS_RE, ERROR_CODES
+from openpyxl.compat import safe_string
+from openpyxl.compat.numbers import NUMERIC_TYPES
+from openpyxl.utils import column_index_from_string
+from openpyxl.formula.tokenizer import Tokenizer, Token
 import glob
+import copy
 import warnings
 import os
+import pickle
+import hashlib
+import json
+import time
+import weakref
+import logging
+import sys
+import argparse
+import contextlib
+import cProfile
+import pstats
+import queue
+import threading
+import importlib.util
+import io
+import re
+import zipfile
+import collections
+import urllib.parse
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 # 忽略openpyxl图表相关的警告
 warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
@@ -11,8 +41,1803 @@ warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
 # 额外添加针对ExternalData.id的特定警告过滤
 warnings.filterwarnings('ignore', message='.*ExternalData.*id should be.*', category=UserWarning)
 
+# 日志：INFO级别只输出各阶段进度和每名学生一行摘要，DEBUG级别输出每个单元格的填充细节
+logger = logging.getLogger("ClassGrade")
+
+
+def setup_logging(level=logging.INFO):
+    """配置日志输出到标准输出"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+class RunTimings:
+    """各阶段耗时统计：每个阶段记录每次执行的秒数，运行结束后汇总为次数、总计和分位数写入JSON运行报告。
+    报告写入线程也会记录耗时，所以用锁保护"""
+
+    percentiles = [50, 90, 95, 99]
+
+    def __init__(self, max_samples=None):
+        # {阶段名: 每次执行的秒数}，阶段名用“/”表示所属的上级阶段
+        self._samples = {}
+        # {阶段名: 执行次数}，包括因max_samples已丢弃的记录
+        self._counts = {}
+        # 每个阶段最多保留的记录数，None为不限；长期运行的服务用它限制内存
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, collections.deque(maxlen=self.max_samples)).append(seconds)
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    def limit(self, max_samples):
+        """限制每个阶段只保留最近max_samples次的耗时，超出后丢弃最早的记录"""
+        with self._lock:
+            self.max_samples = max_samples
+            self._samples = {stage: collections.deque(values, maxlen=max_samples)
+                             for stage, values in self._samples.items()}
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """记录with语句块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def drain(self):
+        """取出并清空已记录的耗时，工作进程用它把耗时交回主进程"""
+        with self._lock:
+            samples, self._samples, self._counts = self._samples, {}, {}
+        return {stage: list(values) for stage, values in samples.items()}
+
+    def merge(self, samples):
+        """并入其他进程记录的耗时"""
+        with self._lock:
+            for stage, values in samples.items():
+                self._samples.setdefault(stage, collections.deque(maxlen=self.max_samples)).extend(values)
+                self._counts[stage] = self._counts.get(stage, 0) + len(values)
+
+    def summary(self):
+        """每个阶段的次数、总计、平均、最大值和分位数（秒）。
+        丢弃过记录的阶段另有samples（保留的记录数），总计、平均、最大值和分位数只按保留的记录计算"""
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for stage, values in samples.items():
+            seconds = np.asarray(values)
+            entry = {'count': counts.get(stage, len(values)), 'total': float(seconds.sum()),
+                     'mean': float(seconds.mean()), 'max': float(seconds.max())}
+            if entry['count'] > len(values):
+                entry['samples'] = len(values)
+            for p, value in zip(self.percentiles, np.percentile(seconds, self.percentiles)):
+                entry[f'p{p}'] = float(value)
+            result[stage] = {key: round(value, 6) for key, value in entry.items()}
+        return result
+
+    def log_summary(self):
+        """按总耗时从大到小输出各阶段的耗时"""
+        summary = self.summary()
+        if not summary:
+            return
+        logger.info("各阶段耗时（秒）:")
+        for stage, entry in sorted(summary.items(), key=lambda item: -item[1]['total']):
+            logger.info(f"  {stage}: 总计 {entry['total']:.3f}，{entry['count']} 次，"
+                        f"p50 {entry['p50']:.4f}，p90 {entry['p90']:.4f}，p99 {entry['p99']:.4f}，最大 {entry['max']:.4f}")
+
+    def save(self, path, **info):
+        """写入JSON运行报告（先写临时文件再替换），info为附加的运行信息（如命令行参数）"""
+        data = {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': round(time.time() - self.started, 3),
+                **info,
+                'stages': self.summary()}
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(path + '.tmp', path)
+            logger.info(f"运行报告已写入: {path}")
+        except OSError as e:
+            logger.warning(f"写入运行报告 {path} 失败: {str(e)}")
+
+
+# 本次运行的耗时统计，各阶段直接记录到这里
+timings = RunTimings()
+
+# 定义9个学期的完整列表，确保能识别所有学期
+SEMESTER_KEYS = ['初一上期中', '初一上期末', '初一下期中', '初一下期末',
+                 '初二上期中', '初二上期末', '初二下期中', '初二下期末', '初三上期中']
+
+# 学期表中的年级、学期和考试，按时间顺序排列
+SCHEDULE_TERMS = ['上', '下']
+SCHEDULE_EXAMS = ['期中', '期末']
+
+
+def parse_semester_schedule(items):
+    """解析学期表：每项是一个完整的学期键（如'初三下期中'），或一个年级（如'初三'、'高一'），
+    年级按 上/下 学期 × 期中/期末 展开为4次考试；返回去重后的学期键列表，保持给出的顺序"""
+    schedule = []
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+        if any(exam in item for exam in SCHEDULE_EXAMS):
+            keys = [item]
+        else:
+            keys = [f"{item}{term}{exam}" for term in SCHEDULE_TERMS for exam in SCHEDULE_EXAMS]
+        schedule.extend(key for key in keys if key not in schedule)
+    return schedule
+
+
+class GradeLoader:
+    """成绩文件加载器：GradeSummaryGenerator和GradeBefore200共用。
+    解析结果按 文件路径+大小+修改时间 缓存在成绩目录下，文件未修改时直接读取缓存"""
+
+    # 缓存目录，位于成绩目录内
+    cache_dir_name = '.grade_cache'
+
+    # 缓存格式版本，读取方式或缓存内容变化时递增，使旧缓存失效
+    cache_version = 4
+
+    def __init__(self, semesters=None, use_cache=True, load_jobs=None, reader='auto', compact=True,
+                 derive_ranks=False, rank_method='min', full_marks=None):
+        self.semesters = list(semesters or SEMESTER_KEYS)
+        self.use_cache = use_cache
+        # 加载后为每个学期计算缺少的校排名/班排名和各科目年级名次（见derive_rank_columns）
+        self.derive_ranks = derive_ranks
+        # 计算排名（包括合并分班文件后重新计算排名）时同分的处理方式，见RANK_METHODS
+        self.rank_method = rank_method
+        # 成绩统计使用的各科满分（见CohortStatistics），None时使用DEFAULT_FULL_MARKS
+        self.full_marks = full_marks
+        # 解析后缩小成绩表（见compact_grade_frame），缓存中保存的也是缩小后的成绩表
+        self.compact = compact
+        # 成绩文件的读取方式，见GRADE_READERS；解析缓存按读取方式分别保存（见_cache_path）
+        self.reader = resolve_reader(reader)
+        # 并发解析成绩文件的进程数，None或0表示按CPU核心数
+        self.load_jobs = load_jobs
+        # 本次运行中已读取的文件，{路径: ((大小, 修改时间), DataFrame)}，文件修改后新结果替换旧结果
+        self._memory_cache = {}
+        # 由最近一次加载的成绩数据建立的成绩库
+        self._store = None
+        self._store_source = None
+        # 最近一次加载的结果，(成绩目录, 文件状态, 成绩数据)；文件都未变化时再次加载直接返回同一份成绩数据，
+        # 两个生成器和成绩统计因此共用同一个成绩库
+        self._loaded = None
+
+    def list_files(self, data_dir):
+        """获取所有成绩文件（.xlsx和.xls）"""
+        all_files = []
+        all_files.extend(glob.glob(os.path.join(data_dir, "*.xlsx")))
+        all_files.extend(glob.glob(os.path.join(data_dir, "*.xls")))
+        return all_files
+
+    def parse_semester_key(self, filename):
+        """从文件名中提取学期键（如'初一上期中'），无法提取时返回None"""
+        grade = None
+        semester = None
+        exam_type = None
+
+        # 首先尝试精确匹配完整的学期键
+        for key in self.semesters:
+            if key in filename:
+                return key
+
+        # 尝试传统的分步提取方式
+        # 提取年级信息
+        if "初一" in filename:
+            grade = "初一"
+        elif "初二" in filename:
+            grade = "初二"
+        elif "初三" in filename:
+            grade = "初三"
+
+        # 提取学期信息
+        if "上" in filename:
+            semester = "上"
+        elif "下" in filename:
+            semester = "下"
+
+        # 提取考试类型信息
+        if "期中" in filename:
+            exam_type = "期中"
+        elif "期末" in filename:
+            exam_type = "期末"
+
+        if not grade or not semester or not exam_type:
+            return None
+        return f"{grade}{semester}{exam_type}"
+
+    def _cache_path(self, file, stat):
+        """缓存文件路径：前半部分由文件路径决定，后半部分由大小、修改时间、缓存格式版本和读取方式决定
+        （不同读取方式解析出的结果各自缓存，不会互相复用）"""
+        path_hash = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()[:16]
+        version = f"{stat.st_size}:{stat.st_mtime_ns}:{self.cache_version}:{self.reader}"
+        version_hash = hashlib.sha1(version.encode('utf-8')).hexdigest()[:16]
+        cache_dir = os.path.join(os.path.dirname(file), self.cache_dir_name)
+        return cache_dir, path_hash, os.path.join(cache_dir, f"{path_hash}_{version_hash}.pkl")
+
+    def _read_cache(self, file):
+        """从内存或磁盘缓存中读取已解析的成绩文件，没有缓存时返回None"""
+        stat = os.stat(file)
+        path = os.path.abspath(file)
+        cached = self._memory_cache.get(path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return cached[1]
+
+        if self.use_cache:
+            _, _, cache_path = self._cache_path(file, stat)
+            if os.path.exists(cache_path):
+                try:
+                    df = pd.read_pickle(cache_path)
+                    self._memory_cache[path] = ((stat.st_size, stat.st_mtime_ns), df)
+                    return df
+                except Exception as e:
+                    logger.warning(f"读取缓存 {cache_path} 失败，将重新解析: {str(e)}")
+        return None
+
+    def _write_cache(self, file, df):
+        """记录新解析的成绩文件，并写入磁盘缓存"""
+        stat = os.stat(file)
+        self._memory_cache[os.path.abspath(file)] = ((stat.st_size, stat.st_mtime_ns), df)
+        if not self.use_cache:
+            return
+
+        cache_dir, path_hash, cache_path = self._cache_path(file, stat)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 删除该文件旧版本的缓存
+            for old_cache in glob.glob(os.path.join(cache_dir, f"{path_hash}_*.pkl")):
+                os.remove(old_cache)
+            df.to_pickle(cache_path)
+        except Exception as e:
+            logger.warning(f"写入缓存 {cache_path} 失败: {str(e)}")
+
+    def _report_load_error(self, file, e):
+        """打印加载文件时的错误信息"""
+        if isinstance(e, ImportError) and 'xlrd' in str(e):
+            logger.error(f"加载文件 {file} 时出错: 需要安装xlrd库来读取.xls文件。请运行: pip install xlrd")
+        else:
+            logger.error(f"加载文件 {file} 时出错: {str(e)}")
+
+    def semester_files(self, data_dir, warn=True):
+        """成绩目录中能识别学期的文件，返回 [(文件, 学期键)]"""
+        semester_files = []
+        for file in self.list_files(data_dir):
+            # 从文件名中提取学期和考试类型信息
+            filename = os.path.basename(file)
+            key = self.parse_semester_key(filename)
+            if key:
+                semester_files.append((file, key))
+            elif warn:
+                logger.warning(f"无法从文件名 {filename} 中提取完整信息，跳过此文件")
+        return semester_files
+
+    def _parse_files(self, pending, frames, executor=None):
+        """解析没有缓存的文件 [(文件, 学期键)]，结果写入frames和缓存。
+        给出executor时在其中并发解析（如批量处理时共用的进程池），否则按load_jobs决定是否并发"""
+        def on_loaded(file, key, df, seconds):
+            timings.record('加载成绩/解析文件', seconds)
+            size = ''
+            if self.compact:
+                before = frame_memory(df)
+                with timings.stage('加载成绩/缩小成绩表'):
+                    df = compact_grade_frame(df)
+                size = f"，内存 {format_size(before)} -> {format_size(frame_memory(df))}"
+            frames[file] = df
+            with timings.stage('加载成绩/写入缓存'):
+                self._write_cache(file, df)
+            logger.info(f"成功加载: {key} - {os.path.basename(file)}（{seconds:.2f}秒，{len(df)}行 x {len(df.columns)}列{size}）")
+
+        def collect(futures):
+            for future in as_completed(futures):
+                file, key = futures[future]
+                try:
+                    df, seconds = future.result()
+                    on_loaded(file, key, df, seconds)
+                except Exception as e:
+                    self._report_load_error(file, e)
+
+        workers = self.load_jobs if self.load_jobs and self.load_jobs > 0 else (os.cpu_count() or 1)
+        workers = min(workers, len(pending))
+        if executor is not None and pending:
+            collect({executor.submit(read_grade_file, file, self.reader): (file, key) for file, key in pending})
+        elif workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                collect({executor.submit(read_grade_file, file, self.reader): (file, key) for file, key in pending})
+        else:
+            for file, key in pending:
+                try:
+                    df, seconds = read_grade_file(file, self.reader)
+                    on_loaded(file, key, df, seconds)
+                except Exception as e:
+                    self._report_load_error(file, e)
+
+    def prefetch(self, data_dirs, executor=None):
+        """预先解析多个成绩目录中没有缓存的文件（所有目录的文件一起并发解析），之后load_all_grades直接使用结果；
+        返回解析的文件数"""
+        pending = []
+        for data_dir in data_dirs:
+            for file, key in self.semester_files(data_dir, warn=False):
+                try:
+                    if self._read_cache(file) is None:
+                        pending.append((file, key))
+                except Exception as e:
+                    logger.error(f"处理文件 {file} 时出错: {str(e)}")
+        self._parse_files(pending, {}, executor)
+        return len(pending)
+
+    def release(self, data_dir):
+        """释放某个成绩目录已读取的数据（批量处理时每个年级处理完后调用），磁盘缓存不受影响"""
+        prefix = os.path.join(os.path.abspath(data_dir), '')
+        for path in [path for path in self._memory_cache if path.startswith(prefix)]:
+            del self._memory_cache[path]
+        self._store = None
+        self._store_source = None
+        self._loaded = None
+
+    def _files_signature(self, data_dir):
+        """成绩目录中各成绩文件的 (文件, 学期键, 大小, 修改时间)，用于判断上次加载的结果是否仍然有效"""
+        signature = []
+        for file, key in self.semester_files(data_dir, warn=False):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            signature.append((os.path.abspath(file), key, stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(signature))
+
+    def load_all_grades(self, data_dir, executor=None):
+        """加载所有成绩文件（支持.xls和.xlsx格式），未缓存的文件并发解析；
+        同一次考试有多个文件时（如按班级分别导出），按文件名顺序合并为一个成绩表，见merge_semester_files"""
+        data_dir_key = os.path.abspath(data_dir)
+        signature = self._files_signature(data_dir)
+        if self._loaded and self._loaded[:2] == (data_dir_key, signature):
+            logger.debug("成绩文件未变化，使用已加载的成绩数据")
+            return self._loaded[2]
+
+        start_time = time.perf_counter()
+        # [(文件, 学期键)]，保持文件顺序
+        semester_files = []
+        frames = {}
+
+        for file, key in self.semester_files(data_dir):
+            try:
+                semester_files.append((file, key))
+                with timings.stage('加载成绩/读取缓存'):
+                    df = self._read_cache(file)
+                if df is not None:
+                    frames[file] = df
+                    logger.info(f"成功加载: {key} - {os.path.basename(file)}（缓存）")
+            except Exception as e:
+                logger.error(f"处理文件 {file} 时出错: {str(e)}")
+
+        # 解析没有缓存的文件
+        pending = [(file, key) for file, key in semester_files if file not in frames]
+        self._parse_files(pending, frames, executor)
+
+        # {学期键: [文件...]}，按学期第一次出现的顺序
+        grouped = {}
+        for file, key in semester_files:
+            if file in frames:
+                grouped.setdefault(key, []).append(file)
+        all_data = {}
+        for key, files in grouped.items():
+            if len(files) == 1:
+                all_data[key] = frames[files[0]]
+            else:
+                with timings.stage('加载成绩/合并分班文件'):
+                    all_data[key] = self.merge_semester_files(key, sorted(files), frames)
+            if self.derive_ranks:
+                with timings.stage('加载成绩/计算排名'):
+                    all_data[key], derived = derive_rank_columns(all_data[key], self.rank_method)
+                logger.debug("%s 计算了排名列: %s", key, derived)
+
+        # 打印加载的所有学期信息，方便调试
+        seconds = time.perf_counter() - start_time
+        timings.record('加载成绩', seconds)
+        if self.derive_ranks:
+            logger.info(f"已为各学期计算缺少的校排名、班排名和各科目年级名次（同分处理方式: {self.rank_method}）")
+        logger.info(f"成功加载的学期数据: {list(all_data.keys())}（读取方式 {self.reader}，耗时 {seconds:.2f}秒，"
+                    f"占用内存 {format_size(sum(frame_memory(df) for df in all_data.values()))}）")
+        self._loaded = (data_dir_key, signature, all_data)
+        return all_data
+
+    def merge_semester_files(self, key, files, frames):
+        """合并同一次考试的多个成绩文件（见merge_class_frames），并提示在多个班级中出现的同名学生"""
+        merged, collisions = merge_class_frames([(class_label(file, key), frames[file]) for file in files],
+                                                self.rank_method)
+        if self.compact:
+            merged = compact_grade_frame(merged)
+        classes = merged[CLASS_COLUMN].astype(str).unique().tolist()
+        logger.info(f"合并: {key} 由 {len(files)} 个文件合并（班级 {classes}），共 {len(merged)} 行，已重新计算校排名和班排名")
+        for name, name_classes in collisions.items():
+            logger.warning(f"警告: {key} 中姓名 '{name}' 出现在多个班级 {name_classes} 中，"
+                           f"报告中只会使用第一条记录，请确认是否为同名学生")
+        return merged
+
+    def get_store(self, all_data):
+        """获取成绩库，同一份成绩数据只整理一次，两个生成器共用"""
+        if self._store_source is not all_data:
+            start_time = time.perf_counter()
+            self._store = GradeStore(all_data, self.semesters)
+            self._store_source = all_data
+            seconds = time.perf_counter() - start_time
+            timings.record('建立成绩库', seconds)
+            logger.info(f"成绩库: {len(self._store.students)} 名学生，{len(self._store.exams)} 条考试记录，"
+                        f"{len(self._store.scores)} 条科目成绩（耗时 {seconds:.2f}秒）")
+        return self._store
+
+    def get_statistics(self, all_data):
+        """获取成绩统计：计算结果保存在成绩库上，同一个成绩库只计算一次，统计工作簿和个人报告中的百分位共用"""
+        store = self.get_store(all_data)
+        full_marks = dict(DEFAULT_FULL_MARKS, **(self.full_marks or {}))
+        if store.statistics is None or store.statistics.full_marks != full_marks:
+            with timings.stage('成绩统计'):
+                store.statistics = CohortStatistics(store, self.full_marks)
+            logger.info(f"成绩统计: {len(store.statistics.table)} 组（学期 × 科目 × 班级）")
+        return store.statistics
+
+
+# 成绩文件中会被用到的列所包含的关键字：姓名、学号、班级、各科目、总分和排名
+GRADE_COLUMN_KEYWORDS = ['姓名', '名字', '学号', '考号', '学籍号', '班',
+                         '语文', '数学', '英语', '地理', '生物', '历史', '政治', '物理', '化学',
+                         '总分', '总成绩', '排名', '名次', '序号', '校次']
+# 以文本方式读取的列
+TEXT_COLUMN_KEYWORDS = ['姓名', '名字', '学号', '考号', '学籍号']
+
+
+def select_grade_columns(columns):
+    """根据表头选出需要读取的列，返回 (列位置列表, {列名: dtype})；
+    找不到姓名列时返回 (None, {})，此时读取全部列以便按字符串列查找姓名"""
+    if not any('姓名' in str(col) or '名字' in str(col) for col in columns):
+        return None, {}
+
+    use_columns = []
+    dtypes = {}
+    for pos, col in enumerate(columns):
+        col_str = str(col).strip()
+        if any(keyword in col_str for keyword in GRADE_COLUMN_KEYWORDS):
+            use_columns.append(pos)
+            if any(keyword in col_str for keyword in TEXT_COLUMN_KEYWORDS) and list(columns).count(col) == 1:
+                dtypes[col] = str
+    return use_columns, dtypes
+
+
+def _excel_value(value):
+    """按pandas读取openpyxl单元格的方式转换值：空单元格为''，整数值的浮点数转为int，错误值为NaN"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        as_int = int(value)
+        return as_int if as_int == value else float(value)
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+def _read_with_pandas(file, engine=None):
+    """用pandas读取：文件只打开和解析一次，在同一个ExcelFile上先读取表头，再只读取需要的列
+    （分两次调用pd.read_excel时，xlrd会把.xls文件完整解析两遍）"""
+    with pd.ExcelFile(file, engine=engine) as excel:
+        columns = excel.parse(nrows=0).columns
+        use_columns, dtypes = select_grade_columns(columns)
+        if use_columns is None:
+            return excel.parse()
+        return excel.parse(usecols=use_columns, dtype=dtypes)
+
+
+def _read_with_calamine(file):
+    """用calamine引擎读取（需要安装python-calamine）"""
+    return _read_with_pandas(file, engine='calamine')
+
+
+def _read_with_openpyxl_stream(file):
+    """用openpyxl只读模式逐行读取，只转换需要的列，再交给pandas的解析器推断类型，
+    结果与pd.read_excel相同；.xls文件仍用pd.read_excel读取"""
+    if not file.lower().endswith(('.xlsx', '.xlsm')):
+        return _read_with_pandas(file)
+
+    wb = load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = [_excel_value(value) for value in next(rows, ())]
+        while header and header[-1] == '':
+            header.pop()
+        if not header:
+            return pd.DataFrame()
+
+        columns = TextParser([header], header=0).read().columns
+        use_columns, dtypes = select_grade_columns(columns)
+        if use_columns is None:
+            # 没有姓名列时读取全部列
+            data = [header]
+            for row in rows:
+                converted = [_excel_value(value) for value in row]
+                while converted and converted[-1] == '':
+                    converted.pop()
+                data.append(converted)
+            while len(data) > 1 and not data[-1]:
+                data.pop()
+            width = max(len(row) for row in data)
+            data = [row + [''] * (width - len(row)) for row in data]
+            return TextParser(data, header=0, skip_blank_lines=False).read()
+
+        data = [[columns[pos] for pos in use_columns]]
+        last_row_with_data = 0
+        for row in rows:
+            width = len(row)
+            data.append([_excel_value(row[pos]) if pos < width else '' for pos in use_columns])
+            # 与pandas一致，只去掉末尾整行为空的行（判断整行而不只是需要的列）
+            if width and row.count(None) + row.count('') < width:
+                last_row_with_data = len(data) - 1
+        del data[last_row_with_data + 1:]
+        return TextParser(data, header=0, dtype=dtypes, skip_blank_lines=False).read()
+    finally:
+        wb.close()
+
+
+# 成绩文件的读取方式，{名称: (读取函数, 需要的模块)}
+GRADE_READERS = {
+    'pandas': (_read_with_pandas, None),
+    'openpyxl': (_read_with_openpyxl_stream, None),
+    'calamine': (_read_with_calamine, 'python_calamine'),
+}
+
+
+def available_readers():
+    """当前环境中可用的读取方式"""
+    return [name for name, (_, module) in GRADE_READERS.items()
+            if module is None or importlib.util.find_spec(module) is not None]
+
+
+def resolve_reader(reader='auto'):
+    """确定实际使用的读取方式：auto在安装了calamine时使用calamine，否则使用pandas默认方式"""
+    available = available_readers()
+    if reader == 'auto':
+        return 'calamine' if 'calamine' in available else 'pandas'
+    if reader not in available:
+        logger.warning(f"读取方式 '{reader}' 不可用（可用: {available}），使用pandas默认方式")
+        return 'pandas'
+    return reader
+
+
+def read_grade_file(file, reader='pandas'):
+    """解析单个成绩文件，只读取需要的列，返回 (DataFrame, 耗时秒数)"""
+    start_time = time.perf_counter()
+    df = GRADE_READERS[reader][0](file)
+    return df, time.perf_counter() - start_time
+
+
+def find_name_columns(df):
+    """按优先级返回可能包含学生姓名的列：'姓名'列、包含'姓名'/'名字'的列，最后是所有字符串列"""
+    name_columns = []
+    # 先检查是否有'姓名'列
+    if '姓名' in df.columns:
+        name_columns.append('姓名')
+    # 再检查包含'姓名'或'名字'的列
+    name_columns.extend([col for col in df.columns
+                         if ('姓名' in str(col) or '名字' in str(col)) and col not in name_columns])
+
+    # 如果没有找到明显的姓名列，尝试所有可能的字符串列
+    if not name_columns:
+        for col in df.columns:
+            try:
+                # 检查该列是否包含字符串类型的数据
+                if df[col].dtype == 'object' or isinstance(df[col].iloc[0], str):
+                    name_columns.append(col)
+            except:
+                continue
+    return name_columns
+
+
+class StudentIndex:
+    """学生索引：加载成绩后一次性为每个学期建立 规范化姓名/学号 -> 行号 的映射，
+    生成报告时按键直接查找，不再对每个学生逐列做字符串包含匹配"""
+
+    # 可作为学生唯一标识的学号列
+    id_columns = ['学号', '考号', '学籍号']
+    # 超过该长度的值不建立子串索引（避免对备注等长文本列做无意义的展开）
+    max_substring_key_length = 10
+
+    def __init__(self, all_data):
+        # {学期: [(列名, {键: [行号...]}, {子串: {键...}}), ...]}，按姓名列优先级排列
+        self.semester_maps = {}
+        # {学期: {学号: 行号}}
+        self.id_maps = {}
+        # {学期: {键: [行号...]}} 同一学期中重复出现的姓名
+        self.duplicates = {}
+        # {学期: {键: [包含该键的其他姓名...]}} 例如"王明"是"王明华"的子串
+        self.ambiguous = {}
+
+        for semester, df in all_data.items():
+            self._build_semester(semester, df)
+
+    @staticmethod
+    def normalize(value):
+        """规范化姓名/学号：转为字符串、去除首尾空格并忽略大小写"""
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return ''
+        return str(value).strip().lower()
+
+    def _build_semester(self, semester, df):
+        """为单个学期建立索引"""
+        column_maps = []
+        for col in find_name_columns(df):
+            exact = {}
+            for pos, value in enumerate(df[col].tolist()):
+                key = self.normalize(value)
+                if key:
+                    exact.setdefault(key, []).append(pos)
+
+            substrings = {}
+            for key in exact:
+                if len(key) > self.max_substring_key_length:
+                    continue
+                for start in range(len(key)):
+                    for end in range(start + 1, len(key) + 1):
+                        substrings.setdefault(key[start:end], set()).add(key)
+            column_maps.append((col, exact, substrings))
+        self.semester_maps[semester] = column_maps
+
+        if not column_maps:
+            return
+
+        # 记录主姓名列中重复和存在包含关系的姓名，便于人工核对
+        _, exact, substrings = column_maps[0]
+        duplicates = {key: rows for key, rows in exact.items() if len(rows) > 1}
+        if duplicates:
+            self.duplicates[semester] = duplicates
+        ambiguous = {}
+        for key in exact:
+            others = substrings.get(key, set()) - {key}
+            if others:
+                ambiguous[key] = sorted(others)
+        if ambiguous:
+            self.ambiguous[semester] = ambiguous
+
+        for id_col in self.id_columns:
+            if id_col in df.columns:
+                ids = {}
+                for pos, value in enumerate(df[id_col].tolist()):
+                    key = self.normalize(value)
+                    if key and key not in ids:
+                        ids[key] = pos
+                self.id_maps[semester] = ids
+                break
+
+    def lookup(self, semester, student, allow_substring=True):
+        """查找学生在某学期中的行号，返回 (行号, 匹配列名)，未找到或无法唯一确定时返回 (None, None)；
+        allow_substring为False时只做精确匹配"""
+        key = self.normalize(student)
+        if not key:
+            return None, None
+
+        ids = self.id_maps.get(semester)
+        if ids and key in ids:
+            return ids[key], '学号'
+
+        for col, exact, substrings in self.semester_maps.get(semester, []):
+            # 优先精确匹配
+            rows = exact.get(key)
+            if rows:
+                return rows[0], col
+            if not allow_substring:
+                continue
+            # 再按子串匹配，但只接受唯一的候选姓名
+            candidates = substrings.get(key)
+            if candidates:
+                if len(candidates) == 1:
+                    return exact[next(iter(candidates))][0], col
+                logger.warning(f"警告: '{student}' 在 {semester} 的列 '{col}' 中匹配到多个学生 {sorted(candidates)}，无法确定，跳过")
+                return None, None
+        return None, None
+
+    def report_ambiguities(self):
+        """打印重复姓名和存在包含关系的姓名"""
+        for semester, duplicates in self.duplicates.items():
+            for key, rows in duplicates.items():
+                logger.warning(f"警告: {semester} 中姓名 '{key}' 出现了 {len(rows)} 次，将使用第一条记录")
+        for semester, ambiguous in self.ambiguous.items():
+            for key, others in ambiguous.items():
+                logger.info(f"提示: {semester} 中姓名 '{key}' 是 {others} 的一部分，已按精确姓名匹配")
+
+
+# 标准科目名称，模板科目和成绩库中的科目都取自这里
+STANDARD_SUBJECTS = ['语文', '数学', '英语', '地理', '生物', '历史', '政治', '物理', '化学', '总分']
+
+
+def find_matching_column(columns, patterns):
+    """在列列表中查找与任何模式匹配的列"""
+    # 首先尝试精确匹配
+    for col in columns:
+        col_str = str(col).strip()
+        for pattern in patterns:
+            if col_str == pattern or col_str.lower() == pattern.lower():
+                return col
+
+    # 然后尝试包含匹配
+    for col in columns:
+        col_str = str(col).strip().lower()
+        for pattern in patterns:
+            if pattern.lower() in col_str:
+                return col
+
+    return None
+
+
+def map_subject_columns(data_columns, subjects):
+    """将数据列与科目进行精确映射，返回 {科目: 数据列}"""
+    mapping = {}
+
+    # 为每个科目查找匹配的数据列
+    for subject in subjects:
+        # 创建匹配模式
+        patterns = [
+            subject,
+            f"{subject}成绩", f"{subject}分数", f"{subject}得分", f"{subject}分",
+            f"期中{subject}", f"期末{subject}", f"{subject}期中", f"{subject}期末"
+        ]
+
+        if subject == "总分":
+            patterns.extend(["总分", "总分成绩", "总分分数", "总分得分", "总分分", "总分数", "总成绩"])
+
+        # 查找匹配的列
+        matched_column = find_matching_column(data_columns, patterns)
+        if matched_column:
+            mapping[subject] = matched_column
+
+    return mapping
+
+
+def collect_student_names(all_data):
+    """从所有数据中提取所有学生姓名"""
+    all_students = set()
+
+    for df_key, df in all_data.items():
+        try:
+            # 尝试多种可能的姓名列名
+            name_column_found = False
+
+            # 尝试直接匹配'姓名'列
+            if '姓名' in df.columns:
+                student_names = df['姓名'].dropna().astype(str).tolist()
+                all_students.update([name.strip() for name in student_names if name.strip()])
+                name_column_found = True
+            else:
+                # 尝试包含'姓名'的列
+                name_columns = [col for col in df.columns if '姓名' in str(col) or '名字' in str(col)]
+                if name_columns:
+                    for col in name_columns:
+                        try:
+                            student_names = df[col].dropna().astype(str).tolist()
+                            all_students.update([name.strip() for name in student_names if name.strip()])
+                            name_column_found = True
+                            break  # 找到一个合适的列就够了
+                        except:
+                            continue
+
+            if not name_column_found:
+                logger.warning(f"在文件 {df_key} 中未找到包含学生姓名的列")
+        except Exception as e:
+            logger.error(f"提取文件 {df_key} 中的学生姓名时出错: {str(e)}")
+
+    return all_students
+
+
+class SemesterSchema:
+    """学期成绩表结构：根据表头一次性确定 科目/总分/排名 对应的数据列"""
+
+    school_rank_variants = ['校排名', '校名次', '序号', '校次']
+    # 没有上述列名时，使用第一个包含这些关键字的列作为校排名（如'校排名(总分)'）
+    school_rank_keywords = ['校排名', '校名次', '校次']
+    class_rank_variants = ['班排名', '班名次', '班级排名', '班级名次']
+    class_variants = ['班级', '班别', '班级名称', '班']
+    total_score_variants = ['总分', '总分成绩', '总分分数', '总分得分', '总分分', '总分数', '总成绩']
+
+    def __init__(self, semester, df, subjects=STANDARD_SUBJECTS):
+        self.semester = semester
+        self.row_count = len(df)
+        # {科目: 数据列}
+        self.subject_columns = map_subject_columns(df.columns, subjects)
+        # 数据中没有对应列的科目
+        self.missing_subjects = [subject for subject in subjects if subject not in self.subject_columns]
+        # 排名和总分按候选列的顺序依次尝试，取第一个非空值
+        self.school_rank_columns = [col for col in self.school_rank_variants if col in df.columns]
+        if not self.school_rank_columns:
+            self.school_rank_columns = [col for col in df.columns
+                                        if any(keyword in str(col) for keyword in self.school_rank_keywords)][:1]
+        self.class_rank_columns = [col for col in self.class_rank_variants if col in df.columns]
+        self.total_score_columns = [col for col in self.total_score_variants if col in df.columns]
+        self.class_columns = [col for col in self.class_variants if col in df.columns]
+        # 计算出的各科目年级名次，{科目: 列名}，见derive_rank_columns
+        self.subject_rank_columns = {subject: SUBJECT_RANK_COLUMN.format(subject) for subject in self.subject_columns
+                                     if SUBJECT_RANK_COLUMN.format(subject) in df.columns}
+
+    def __str__(self):
+        lines = [f"{self.semester}（{self.row_count}行）的数据列映射:"]
+        for subject, col in self.subject_columns.items():
+            lines.append(f"  {subject} <- '{col}'")
+        if self.missing_subjects:
+            lines.append(f"  未找到对应列的科目: {self.missing_subjects}")
+        lines.append(f"  总分 <- {self.total_score_columns or '未找到'}")
+        lines.append(f"  校排名 <- {self.school_rank_columns or '未找到'}")
+        lines.append(f"  班排名 <- {self.class_rank_columns or '未找到'}")
+        return "\n".join(lines)
+
+
+def _column_values(df, col, rows):
+    """取出某列在指定行号上的值（存在同名列时使用第一列）"""
+    position = list(df.columns).index(col)
+    return df.iloc[:, position].to_numpy(dtype=object)[rows]
+
+
+def _first_numeric(df, columns, rows):
+    """按顺序在候选列中取第一个非空值并转为数值，都为空或不是数值时为NaN"""
+    values = pd.Series(np.full(len(rows), None, dtype=object))
+    for col in columns:
+        values = values.where(values.notna(), _column_values(df, col, rows))
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+
+
+def frame_memory(df):
+    """DataFrame占用的内存（字节），包括字符串等对象本身"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def format_size(size):
+    """把字节数格式化为便于阅读的大小"""
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def _compact_column(series, categorical=True):
+    """把一列转为更小的类型，取值不变；无法缩小时原样返回。categorical为False时文本列保持原样"""
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        # 班级、排名等整数列转为能容纳其取值的最小整数类型
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series):
+        # 只有每个值都能用float32精确表示时才转换（如整数或x.5分），保证数值不变
+        values = series.to_numpy()
+        narrow = values.astype(np.float32)
+        if np.array_equal(narrow.astype(values.dtype), values, equal_nan=True):
+            return pd.Series(narrow, index=series.index, name=series.name)
+        return series
+    if categorical and not isinstance(series.dtype, pd.CategoricalDtype) and len(series):
+        # 重复值多的文本列（如班级名称）转为分类类型；姓名、学号等几乎不重复的列转换后反而更大
+        if series.nunique(dropna=True) <= len(series) // 2:
+            return series.astype('category')
+    return series
+
+
+def compact_grade_frame(df, subjects=STANDARD_SUBJECTS):
+    """缩小一个学期的成绩表：只保留用到的列（姓名、学号、班级、科目、总分和排名），
+    并逐列转为更小的类型（见_compact_column）。各单元格的值不变，生成的报告与缩小前相同"""
+    schema = SemesterSchema(None, df, subjects)
+    # 姓名和学号列保持原来的类型，查找姓名列时按类型判断的结果不变
+    text_columns = set(find_name_columns(df))
+    text_columns.update(col for col in StudentIndex.id_columns if col in df.columns)
+    used = set(text_columns)
+    used.update(schema.subject_columns.values())
+    used.update(schema.school_rank_columns + schema.class_rank_columns + schema.total_score_columns)
+    used.update(schema.class_columns)
+
+    # 按位置处理，存在同名列时也能保持列的顺序
+    positions = [pos for pos, col in enumerate(df.columns) if col in used]
+    columns = [_compact_column(df.iloc[:, pos], df.columns[pos] not in text_columns) for pos in positions]
+    if not columns:
+        return df.iloc[:, []]
+    compacted = pd.concat(columns, axis=1)
+    compacted.columns = df.columns[positions]
+    return compacted
+
+
+# 合并后的班级列名
+CLASS_COLUMN = '班级'
+
+
+def class_label(filename, semester_key):
+    """从分班导出的文件名中提取班级（如'初二上期末_3班.xlsx' -> '3班'），
+    没有'X班'字样时使用去掉学期和'成绩'后剩下的部分，什么都不剩时使用整个文件名"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    match = re.search(r'[0-9一二三四五六七八九十]+班', stem)
+    if match:
+        return match.group(0)
+    rest = stem.replace(semester_key, '').replace('成绩', '').strip(' _-()（）')
+    return rest or stem
+
+
+def normalize_class_name(value):
+    """统一班级的写法：只有数字的班级（如 3、'3'、3.0）写为'3班'，其他原样去除首尾空格"""
+    text = str(value).strip()
+    if re.fullmatch(r'\d+(\.0+)?', text):
+        return f"{int(float(text))}班"
+    return text
+
+
+# 同分时的名次计算方式，{名称: 说明}，名称即pandas rank的method参数
+RANK_METHODS = {
+    'min': '同分名次相同，后面的名次顺延（1、2、2、4）',
+    'dense': '同分名次相同，后面的名次连续（1、2、2、3）',
+    'max': '同分都取其中最靠后的名次（1、3、3、4）',
+    'first': '同分按在成绩表中的顺序依次排名（1、2、3、4）',
+}
+
+# 计算出的各科目校排名的列名
+SUBJECT_RANK_COLUMN = '{}年级名次'
+
+
+def class_sort_key(name):
+    """班级的排序键：按班号排序（2班在10班之前），没有班号的排在后面"""
+    match = re.search(r'\d+', name)
+    return (0, int(match.group(0)), name) if match else (1, 0, name)
+
+
+def rank_descending(values, groups=None, method='min'):
+    """按分数从高到低排名，同分时按method（见RANK_METHODS）处理，分数为空时名次为空；
+    给出groups时在每组内分别排名"""
+    values = pd.Series(values, dtype=float)
+    if groups is None:
+        return values.rank(method=method, ascending=False).to_numpy()
+    return values.groupby(np.asarray(groups), sort=False).rank(method=method, ascending=False).to_numpy()
+
+
+def derive_rank_columns(df, method='min', subjects=STANDARD_SUBJECTS):
+    """为成绩表计算排名列，每个学期一次向量化计算：缺少校排名时按总分计算'校排名'，
+    缺少班排名且有班级列时按班级分组计算'班排名'，并为每个科目计算年级名次（见SUBJECT_RANK_COLUMN）。
+    已有的排名列保持不变，返回 (新的DataFrame, 新增的列名列表)"""
+    schema = SemesterSchema(None, df, subjects)
+    rows = np.arange(len(df))
+    derived = {}
+    if schema.total_score_columns:
+        total = _first_numeric(df, schema.total_score_columns, rows)
+        if not schema.school_rank_columns:
+            derived['校排名'] = rank_descending(total, method=method)
+        if not schema.class_rank_columns and schema.class_columns:
+            derived['班排名'] = rank_descending(total, _column_values(df, schema.class_columns[0], rows), method)
+    for subject, col in schema.subject_columns.items():
+        derived[SUBJECT_RANK_COLUMN.format(subject)] = rank_descending(_first_numeric(df, [col], rows), method=method)
+    return df.assign(**derived), list(derived)
+
+
+def merge_class_frames(parts, method='min'):
+    """把同一次考试的多个分班成绩表 [(班级, DataFrame)] 按顺序合并为一个成绩表：
+    添加班级列（成绩表中已有班级列时优先使用其中的值），按合并后的总分重新计算校排名和班排名
+    （同分时按method处理，见RANK_METHODS），
+    返回 (合并后的DataFrame, {姓名: [班级...]})，后者为出现在多个班级中的姓名"""
+    frames = []
+    for label, df in parts:
+        class_columns = SemesterSchema(None, df).class_columns
+        if class_columns:
+            classes = df[class_columns[0]].astype(object).where(df[class_columns[0]].notna(), label)
+            df = df.drop(columns=class_columns)
+        else:
+            classes = label
+        df = df.copy()
+        df[CLASS_COLUMN] = pd.Series(classes, index=df.index, dtype=object).map(normalize_class_name)
+        frames.append(df)
+    merged = pd.concat(frames, ignore_index=True)
+
+    schema = SemesterSchema(None, merged)
+    if schema.total_score_columns:
+        total = _first_numeric(merged, schema.total_score_columns, np.arange(len(merged)))
+        classes = merged[CLASS_COLUMN].to_numpy()
+        for col in schema.school_rank_columns or ['校排名']:
+            merged[col] = rank_descending(total, method=method)
+        for col in schema.class_rank_columns or ['班排名']:
+            merged[col] = rank_descending(total, classes, method)
+    else:
+        logger.warning("合并的成绩表中没有总分列，无法重新计算排名，保留各文件中原有的排名")
+
+    collisions = {}
+    name_columns = find_name_columns(merged)
+    if name_columns:
+        names = merged[name_columns[0]].map(StudentIndex.normalize)
+        pairs = pd.DataFrame({'name': names, 'class': merged[CLASS_COLUMN]})
+        pairs = pairs[pairs['name'] != ''].drop_duplicates()
+        repeated = pairs[pairs.duplicated('name', keep=False)]
+        collisions = {name: sorted(group) for name, group in repeated.groupby('name', sort=True)['class']}
+    return merged, collisions
+
+
+class GradeStore:
+    """规范化的成绩库：加载后一次性把所有学期整理成长表，
+    个人报告和前200名统计都从这里读取，不再各自在DataFrame中查找姓名、科目和排名列。
+
+    scores: 每行一个 (学生, 学期, 科目) 的成绩，列为 student/semester/subject/class/score/score_text/
+            class_rank/school_rank/subject_rank，学生、学期、科目和班级以分类编码存储；成绩不是数值时（如'缺考'）
+            score为NaN，原文保存在score_text中；subject_rank为该科目的年级名次（计算了排名时才有）
+    exams:  每行一名学生的一次考试，列为 student/semester/class/total_score/class_rank/school_rank/row，
+            row为该学生在原成绩表中的行号；成绩表中没有班级列时class为空
+    两张表都按 学生、学期 排序，查询单个学生时按偏移量直接切片"""
+
+    exam_columns = ['student', 'semester', 'class', 'total_score', 'class_rank', 'school_rank', 'row']
+    score_columns = ['student', 'semester', 'subject', 'class', 'score', 'score_text', 'class_rank', 'school_rank',
+                     'subject_rank']
+
+    def __init__(self, all_data, semesters=SEMESTER_KEYS, subjects=STANDARD_SUBJECTS):
+        self.index = StudentIndex(all_data)
+        # 先按学期列表的顺序，再追加不在列表中的学期
+        self.semesters = ([semester for semester in semesters if semester in all_data]
+                          + [semester for semester in all_data if semester not in semesters])
+        self.subjects = list(subjects)
+        self.schemas = {semester: SemesterSchema(semester, all_data[semester], self.subjects)
+                        for semester in self.semesters}
+        self.students = sorted(collect_student_names(all_data))
+        self.student_codes = {name: code for code, name in enumerate(self.students)}
+
+        exam_parts = []
+        score_parts = []
+        for semester_code, semester in enumerate(self.semesters):
+            exams, scores = self._build_semester(semester_code, semester, all_data[semester])
+            exam_parts.append(exams)
+            score_parts.extend(scores)
+
+        # 所有学期中出现的班级，按班号排序；各表中的班级转为编码，没有班级的为-1
+        self.classes = sorted({name for part in exam_parts for name in part['class'] if name is not None},
+                              key=class_sort_key)
+        for part in exam_parts + score_parts:
+            part['class'] = pd.Categorical(part['class'], categories=self.classes).codes.astype(np.int64)
+
+        self.exams = self._assemble(exam_parts, self.exam_columns, ('student', 'semester'))
+        self.scores = self._assemble(score_parts, self.score_columns, ('student', 'semester', 'subject'))
+
+        # 学生编码 -> 在两张表中的起止位置
+        student_range = np.arange(len(self.students) + 1)
+        self._exam_offsets = np.searchsorted(self.exams['student'].cat.codes.to_numpy(), student_range)
+        self._score_offsets = np.searchsorted(self.scores['student'].cat.codes.to_numpy(), student_range)
+        self._exam_semesters = self.exams['semester'].cat.codes.to_numpy()
+        self._score_semesters = self.scores['semester'].cat.codes.to_numpy()
+        self._score_subjects = self.scores['subject'].cat.codes.to_numpy()
+        # 由该成绩库计算的成绩统计（见GradeLoader.get_statistics）
+        self.statistics = None
+
+    def _match_rows(self, semester):
+        """确定每名学生在该学期中的行号，返回 {学生编码: 行号}。
+        先为所有学生做精确匹配，再对未找到的学生按子串匹配；已被其他学生精确匹配的行不再分配，
+        避免'王明'某次缺考时取到'王明华'的成绩"""
+        rows = {}
+        pending = []
+        for code, student in enumerate(self.students):
+            pos, _ = self.index.lookup(semester, student, allow_substring=False)
+            if pos is None:
+                pending.append(code)
+            else:
+                rows[code] = pos
+        claimed = set(rows.values())
+        for code in pending:
+            pos, _ = self.index.lookup(semester, self.students[code])
+            if pos is not None and pos not in claimed:
+                rows[code] = pos
+                claimed.add(pos)
+        return rows
+
+    def _build_semester(self, semester_code, semester, df):
+        """把一个学期的成绩表转为长表的各列"""
+        schema = self.schemas[semester]
+        matched = self._match_rows(semester)
+        codes = np.fromiter(matched.keys(), dtype=np.int64, count=len(matched))
+        rows = np.fromiter(matched.values(), dtype=np.int64, count=len(matched))
+
+        class_rank = _first_numeric(df, schema.class_rank_columns, rows)
+        school_rank = _first_numeric(df, schema.school_rank_columns, rows)
+        classes = np.full(len(rows), None, dtype=object)
+        if schema.class_columns:
+            values = pd.Series(_column_values(df, schema.class_columns[0], rows))
+            present = values.notna().to_numpy()
+            classes[present] = values[present].map(normalize_class_name).to_numpy()
+        exams = {
+            'student': codes,
+            'semester': np.full(len(codes), semester_code),
+            'class': classes,
+            'total_score': _first_numeric(df, schema.total_score_columns, rows),
+            'class_rank': class_rank,
+            'school_rank': school_rank,
+            'row': rows,
+        }
+
+        scores = []
+        for subject, col in schema.subject_columns.items():
+            rank_columns = [schema.subject_rank_columns[subject]] if subject in schema.subject_rank_columns else []
+            raw = _column_values(df, col, rows)
+            numeric = pd.to_numeric(pd.Series(raw), errors='coerce').to_numpy(dtype=float)
+            present = np.flatnonzero(pd.notna(raw))
+            text = np.full(len(present), None, dtype=object)
+            for i, pos in enumerate(present):
+                if np.isnan(numeric[pos]):
+                    text[i] = raw[pos]
+                    logger.warning(f"警告: {self.students[codes[pos]]} 在 {semester} 中 {col} 的值 "
+                                   f"'{raw[pos]}' 无法转换为数值")
+            scores.append({
+                'student': codes[present],
+                'semester': np.full(len(present), semester_code),
+                'subject': np.full(len(present), self.subjects.index(subject)),
+                'class': classes[present],
+                'score': numeric[present],
+                'score_text': text,
+                'class_rank': class_rank[present],
+                'school_rank': school_rank[present],
+                'subject_rank': _first_numeric(df, rank_columns, rows)[present],
+            })
+        return exams, scores
+
+    def _assemble(self, parts, columns, sort_keys):
+        """合并各学期的列，转为分类编码并按 sort_keys 排序"""
+        categories = {'student': self.students, 'semester': self.semesters, 'subject': self.subjects,
+                      'class': self.classes}
+        data = {}
+        for name in columns:
+            if parts:
+                data[name] = np.concatenate([part[name] for part in parts])
+            else:
+                data[name] = np.array([], dtype=object if name == 'score_text' else
+                                      np.int64 if name in categories or name == 'row' else float)
+        order = np.lexsort([data[key] for key in reversed(sort_keys)])
+        frame = {}
+        for name in columns:
+            values = data[name][order]
+            if name in categories:
+                frame[name] = pd.Categorical.from_codes(values, categories=categories[name],
+                                                        ordered=(name == 'semester'))
+            else:
+                frame[name] = values
+        return pd.DataFrame(frame)
+
+    def _student_bounds(self, offsets, student):
+        """学生在某张表中的 (起, 止) 位置，不存在的学生返回 (0, 0)"""
+        code = self.student_codes.get(student)
+        if code is None:
+            return 0, 0
+        return offsets[code], offsets[code + 1]
+
+    def student_history(self, student):
+        """单个学生所有学期各科的成绩（长表格式）"""
+        start, end = self._student_bounds(self._score_offsets, student)
+        return self.scores.iloc[start:end].reset_index(drop=True)
+
+    def student_exams(self, student):
+        """单个学生每次考试的总分和排名"""
+        start, end = self._student_bounds(self._exam_offsets, student)
+        return self.exams.iloc[start:end].reset_index(drop=True)
+
+    def student_record(self, student):
+        """单个学生的成绩，返回 {学期: {'subjects': {科目: 成绩}, 'total_score', 'class_rank', 'school_rank'}}，
+        缺失的值为None；生成报告时使用，避免为每名学生创建DataFrame"""
+        record = {}
+        start, end = self._student_bounds(self._exam_offsets, student)
+        totals = self.exams['total_score'].to_numpy()
+        class_ranks = self.exams['class_rank'].to_numpy()
+        school_ranks = self.exams['school_rank'].to_numpy()
+        for i in range(start, end):
+            record[self.semesters[self._exam_semesters[i]]] = {
+                'subjects': {},
+                'total_score': None if np.isnan(totals[i]) else float(totals[i]),
+                'class_rank': None if np.isnan(class_ranks[i]) else float(class_ranks[i]),
+                'school_rank': None if np.isnan(school_ranks[i]) else float(school_ranks[i]),
+            }
+
+        start, end = self._student_bounds(self._score_offsets, student)
+        scores = self.scores['score'].to_numpy()
+        texts = self.scores['score_text'].to_numpy()
+        for i in range(start, end):
+            value = texts[i] if np.isnan(scores[i]) else float(scores[i])
+            subjects = record[self.semesters[self._score_semesters[i]]]['subjects']
+            subjects[self.subjects[self._score_subjects[i]]] = value
+        return record
+
+    def semester_ranking(self, semester, max_rank=None):
+        """某学期按校排名排序的学生（没有校排名的学生不在其中），max_rank不为None时只返回排名不超过它的学生；
+        排名相同时按在原成绩表中的顺序。先按排名筛选再排序，只需要前几百名时不必对整个年级排序"""
+        if semester not in self.semesters:
+            return self.exams.iloc[:0][['student', 'school_rank', 'class_rank', 'total_score']]
+        school_ranks = self.exams['school_rank'].to_numpy()
+        mask = (self._exam_semesters == self.semesters.index(semester)) & ~np.isnan(school_ranks)
+        if max_rank is not None:
+            mask &= school_ranks <= max_rank
+        positions = np.flatnonzero(mask)
+        positions = positions[np.lexsort((self.exams['row'].to_numpy()[positions], school_ranks[positions]))]
+        return self.exams.iloc[positions][['student', 'school_rank', 'class_rank', 'total_score']].reset_index(drop=True)
+
+    def semester_tiers(self, semester, thresholds):
+        """某学期各档次（校排名不超过各阈值）的学生，返回 {阈值: [学生...]}，按排名排序；
+        所有档次由同一次筛选得到，较小的档次是较大档次的前缀"""
+        if not thresholds:
+            return {}
+        ranking = self.semester_ranking(semester, max_rank=max(thresholds))
+        students = ranking['student'].astype(str).tolist()
+        ranks = ranking['school_rank'].to_numpy()
+        return {threshold: students[:np.searchsorted(ranks, threshold, side='right')] for threshold in thresholds}
+
+    def rank_matrix(self, semesters=None):
+        """学生 × 学期 的校排名矩阵，行按students、列按semesters的顺序，没有排名为NaN"""
+        semesters = list(self.semesters if semesters is None else semesters)
+        matrix = np.full((len(self.students), len(self.semesters)), np.nan)
+        matrix[self.exams['student'].cat.codes.to_numpy(), self._exam_semesters] = self.exams['school_rank'].to_numpy()
+        return matrix[:, [self.semesters.index(semester) for semester in semesters]]
+
+    def top_membership(self, max_rank):
+        """统计每名学生在各学期是否进入前max_rank名，全部按学期逐列向量化计算。
+        只使用有校排名的学期，缺考的学期视为不在前max_rank名。
+        返回 (学生汇总, 学期汇总)：学生汇总只包含至少进入过一次的学生，
+        列为各学期的名次（不在前max_rank名为NaN）、上榜次数、最长连续、当前连续、进入次数、退出次数、每次都在；
+        学期汇总的行为 人数、新进入、退出"""
+        semesters = [semester for semester in self.semesters if self.schemas[semester].school_rank_columns]
+        ranks = self.rank_matrix(semesters)
+        with np.errstate(invalid='ignore'):
+            member = ranks <= max_rank
+
+        # 连续上榜次数：逐学期累加，不在榜时清零
+        run = np.zeros(len(self.students), dtype=int)
+        longest = np.zeros(len(self.students), dtype=int)
+        for j in range(len(semesters)):
+            run = (run + 1) * member[:, j]
+            longest = np.maximum(longest, run)
+
+        entered = np.zeros_like(member)
+        exited = np.zeros_like(member)
+        if semesters:
+            entered[:, 0] = member[:, 0]
+            entered[:, 1:] = member[:, 1:] & ~member[:, :-1]
+            exited[:, 1:] = ~member[:, 1:] & member[:, :-1]
+
+        appearances = member.sum(axis=1)
+        summary = pd.DataFrame(np.where(member, ranks, np.nan), columns=semesters)
+        summary.insert(0, 'student', self.students)
+        summary['上榜次数'] = appearances
+        summary['最长连续'] = longest
+        summary['当前连续'] = run
+        summary['进入次数'] = entered.sum(axis=1)
+        summary['退出次数'] = exited.sum(axis=1)
+        summary['每次都在'] = appearances == len(semesters)
+
+        # 上榜次数多的在前，次数相同按最好名次
+        best_rank = np.where(member, ranks, np.inf).min(axis=1) if semesters else np.zeros(len(self.students))
+        order = np.lexsort((best_rank, -appearances))
+        summary = summary.iloc[order[appearances[order] > 0]].reset_index(drop=True)
+
+        by_semester = pd.DataFrame([member.sum(axis=0), entered.sum(axis=0), exited.sum(axis=0)],
+                                   index=['人数', '新进入', '退出'], columns=semesters)
+        return summary, by_semester
+
+
+# 各科满分，未列出的科目为100分；总分的满分为该学期各科满分之和（与成绩模板中"参考数"一行相同）
+DEFAULT_FULL_MARKS = {'语文': 120, '数学': 120, '英语': 120}
+# 及格线占满分的比例
+PASS_RATIO = 0.6
+# 统计表中的分数段（百分位）
+STATISTICS_PERCENTILES = [10, 25, 50, 75, 90]
+# 统计表中代表全年级的"班级"
+ALL_CLASSES = '全年级'
+
+
+def parse_full_marks(items):
+    """解析命令行的各科满分（如 ['语文=150', '数学=150']），返回 {科目: 满分}"""
+    full_marks = {}
+    for item in items or []:
+        subject, _, score = item.partition('=')
+        try:
+            full_marks[subject.strip()] = float(score)
+        except ValueError:
+            raise ValueError(f"无法解析满分 '{item}'，应写为 科目=分数，如 语文=150")
+    return full_marks
+
+
+class CohortStatistics:
+    """年级成绩统计：在成绩库的长表上一次分组，计算每个 学期 × 科目 × 班级（以及全年级）的
+    参考人数、平均分、中位数、最高分、最低分、标准差、及格率和各百分位的分数；
+    同时用一次分组排名得到每条成绩在全年级中的百分位，生成个人报告时按学生直接查表，不再重新计算。
+
+    table: 每行一个 (学期, 科目, 班级) 的统计，班级为ALL_CLASSES的行是全年级统计
+    score_percentiles: 与成绩库scores表逐行对应的百分位（0-100，全年级中分数不高于该成绩的人数占比）"""
+
+    def __init__(self, store, full_marks=None, pass_ratio=PASS_RATIO, percentiles=STATISTICS_PERCENTILES):
+        self.store = store
+        self.full_marks = dict(DEFAULT_FULL_MARKS, **(full_marks or {}))
+        self.pass_ratio = pass_ratio
+        self.percentiles = list(percentiles)
+
+        scores = store.scores
+        semester_codes = store._score_semesters
+        subject_codes = store._score_subjects
+        values = scores['score'].to_numpy(dtype=float)
+        # 及格线，[学期编码, 科目编码]
+        self.pass_lines = self._pass_lines() * pass_ratio
+        lines = self.pass_lines[semester_codes, subject_codes]
+        passed = np.where(np.isnan(values) | np.isnan(lines), np.nan, values >= lines)
+
+        frame = pd.DataFrame({'学期': scores['semester'], '科目': scores['subject'], 'score': values})
+        self.score_percentiles = (frame.groupby(['学期', '科目'], observed=True)['score']
+                                  .rank(method='max', pct=True) * 100).to_numpy()
+
+        # 每条成绩计入全年级一次，有班级时再计入所在班级一次，之后只分组一次
+        class_codes = scores['class'].cat.codes.to_numpy()
+        with_class = np.flatnonzero(class_codes >= 0)
+        rows = np.concatenate([np.arange(len(scores)), with_class])
+        combined = pd.DataFrame({
+            '学期': pd.Categorical.from_codes(semester_codes[rows], categories=store.semesters, ordered=True),
+            '科目': pd.Categorical.from_codes(subject_codes[rows], categories=store.subjects, ordered=True),
+            '班级': pd.Categorical.from_codes(np.concatenate([np.zeros(len(scores), dtype=np.int64),
+                                                           class_codes[with_class] + 1]),
+                                            categories=[ALL_CLASSES] + store.classes, ordered=True),
+            'score': values[rows],
+            'passed': passed[rows],
+        })
+        groups = combined.groupby(['学期', '科目', '班级'], observed=True, sort=True)
+        table = groups.agg(参考人数=('score', 'count'), 平均分=('score', 'mean'), 中位数=('score', 'median'),
+                           最高分=('score', 'max'), 最低分=('score', 'min'), 标准差=('score', 'std'),
+                           及格率=('passed', 'mean'))
+        bands = groups['score'].quantile([p / 100 for p in self.percentiles]).unstack()
+        bands.columns = [f"P{p}" for p in self.percentiles]
+        table = table.join(bands).reset_index()
+        table.insert(3, '及格线', self.pass_lines[table['学期'].cat.codes, table['科目'].cat.codes])
+        self.table = table
+
+    def _pass_lines(self):
+        """各学期各科目的满分，[学期编码, 科目编码]；总分为该学期有成绩的各科满分之和"""
+        store = self.store
+        marks = np.full((len(store.semesters), len(store.subjects)), np.nan)
+        for i, semester in enumerate(store.semesters):
+            subjects = [subject for subject in store.schemas[semester].subject_columns if subject != '总分']
+            for subject in subjects:
+                marks[i, store.subjects.index(subject)] = self.full_marks.get(subject, 100)
+            if '总分' in store.subjects:
+                marks[i, store.subjects.index('总分')] = self.full_marks.get(
+                    '总分', sum(self.full_marks.get(subject, 100) for subject in subjects) if subjects else np.nan)
+        return marks
+
+    def student_percentiles(self, student):
+        """单个学生各学期各科成绩的百分位，返回 {学期: {科目: 百分位}}"""
+        result = {}
+        start, end = self.store._student_bounds(self.store._score_offsets, student)
+        for i in range(start, end):
+            if not np.isnan(self.score_percentiles[i]):
+                semester = self.store.semesters[self.store._score_semesters[i]]
+                result.setdefault(semester, {})[self.store.subjects[self.store._score_subjects[i]]] = \
+                    float(self.score_percentiles[i])
+        return result
+
+    def save(self, path):
+        """把统计表写入工作簿：'成绩统计'工作表为完整的长表，'平均分对比'工作表按学期和班级列出各科平均分"""
+        from openpyxl import Workbook
+
+        header_font = Font(bold=True, color="000000")
+        wb = Workbook()
+        ws = wb.active
+        ws.title = '成绩统计'
+        ws.append(list(self.table.columns))
+        for row in self.table.itertuples(index=False):
+            ws.append([None if isinstance(value, float) and np.isnan(value) else
+                       value.item() if isinstance(value, np.generic) else value for value in row])
+        formats = {'平均分': '0.00', '中位数': '0.0', '标准差': '0.00', '及格率': '0.0%'}
+        formats.update({f"P{p}": '0.0' for p in self.percentiles})
+        for col, name in enumerate(self.table.columns, start=1):
+            ws.cell(row=1, column=col).font = header_font
+            if name in formats:
+                for (cell,) in ws.iter_rows(min_row=2, min_col=col, max_col=col):
+                    cell.number_format = formats[name]
+        ws.freeze_panes = 'D2'
+        ws.auto_filter.ref = ws.dimensions
+
+        averages = self.table.pivot_table(index=['学期', '班级'], columns='科目', values='平均分', observed=True)
+        ws = wb.create_sheet('平均分对比')
+        ws.append(['学期', '班级'] + [str(subject) for subject in averages.columns])
+        for (semester, class_name), values in averages.iterrows():
+            ws.append([semester, class_name] + [None if np.isnan(value) else round(float(value), 2)
+                                                for value in values])
+        for cell in ws[1]:
+            cell.font = header_font
+        ws.freeze_panes = 'C2'
+        wb.save(path)
+
+
+def report_filename(student_name):
+    """学生个人报告的文件名"""
+    return f"{student_name}_成绩总结.xlsx"
+
+
+# 工作表名称中不能出现的字符
+INVALID_SHEET_TITLE_CHARS = re.compile(r'[\\/*?:\[\]]')
+
+
+def sheet_title(student_name, used_titles):
+    """学生在合并工作簿中的工作表名称：去掉不允许的字符，不超过31个字符，
+    与已有名称重复（不区分大小写）时加上序号"""
+    base = INVALID_SHEET_TITLE_CHARS.sub('_', str(student_name)).strip("'") or '学生'
+    title = base[:31]
+    number = 2
+    while title.lower() in used_titles:
+        suffix = f"({number})"
+        title = base[:31 - len(suffix)] + suffix
+        number += 1
+    used_titles.add(title.lower())
+    return title
+
+
+class StudentReport:
+    """单个学生报告的内容：需要写入模板的单元格 (行, 列, 值) 及填充统计"""
+
+    def __init__(self, student_name, semester_count):
+        self.student_name = student_name
+        self.semester_count = semester_count
+        self.cells = []
+        self.found_semesters = 0
+        self.filled_subjects = 0
+
+    def digest(self):
+        """报告内容的哈希值，内容相同的报告哈希值相同"""
+        return hashlib.sha1(repr(self.cells).encode('utf-8')).hexdigest()
+
+
+class ReportManifest:
+    """增量生成清单：保存在输出目录中，记录每名学生报告的内容哈希和所用模板的哈希，
+    再次运行时内容和模板都没有变化的报告不再重新生成"""
+
+    filename = '.report_manifest.json'
+    # 报告格式版本，报告的生成方式变化时递增，使所有报告重新生成
+    format_version = 1
+
+    def __init__(self, output_dir, template_digest=None, entries=None):
+        self.output_dir = output_dir
+        self.template_digest = template_digest
+        # {学生姓名: 报告内容哈希}
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, output_dir):
+        """读取输出目录中的清单，不存在或无法读取时返回空清单"""
+        path = os.path.join(output_dir, cls.filename)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format_version') == cls.format_version:
+                return cls(output_dir, data.get('template_digest'), data.get('students', {}))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"读取增量生成清单 {path} 失败，将重新生成所有报告: {str(e)}")
+        return cls(output_dir)
+
+    def is_current(self, student, digest, template_digest):
+        """学生报告是否已是最新：内容和模板都没有变化，且报告文件仍然存在"""
+        return (self.template_digest == template_digest
+                and self.entries.get(student) == digest
+                and os.path.exists(os.path.join(self.output_dir, report_filename(student))))
+
+    def record(self, student, digest):
+        self.entries[student] = digest
+
+    def forget(self, student):
+        self.entries.pop(student, None)
+
+    def remove_missing(self, current_students):
+        """删除清单中记录、但已不在成绩数据中的学生的报告，返回被删除的学生列表"""
+        removed = []
+        for student in sorted(set(self.entries) - set(current_students)):
+            path = os.path.join(self.output_dir, report_filename(student))
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                removed.append(student)
+                self.forget(student)
+            except OSError as e:
+                logger.warning(f"删除报告 {path} 失败: {str(e)}")
+        return removed
+
+    def save(self):
+        """写入清单（先写临时文件再替换，避免中断时留下损坏的清单）"""
+        path = os.path.join(self.output_dir, self.filename)
+        data = {'format_version': self.format_version, 'template_digest': self.template_digest,
+                'students': self.entries}
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning(f"写入增量生成清单 {path} 失败: {str(e)}")
+
+
+class ReportPlan:
+    """一次增量生成：与输出目录中的清单对比，跳过内容和模板都没有变化的报告，
+    结束后只把成功生成的报告记入清单（失败的下次运行会重新生成）。只保留每份报告的摘要，不保留报告内容"""
+
+    def __init__(self, output_dir, template_digest, incremental=True):
+        self.manifest = ReportManifest.load(output_dir) if incremental else ReportManifest(output_dir)
+        self.template_digest = template_digest
+        self.incremental = incremental
+        # {学生姓名: 报告内容哈希}，需要重新生成的报告
+        self.digests = {}
+        self.skipped = []
+        self.removed = []
+        self.succeeded = []
+        # 提取报告内容时出错的学生
+        self.failed = []
+
+    def changed(self, reports):
+        """逐个检查报告内容，只返回有变化的报告"""
+        for report in reports:
+            digest = report.digest()
+            if self.incremental and self.manifest.is_current(report.student_name, digest, self.template_digest):
+                self.skipped.append(report.student_name)
+                continue
+            self.digests[report.student_name] = digest
+            yield report
+
+    def remove_missing(self, current_students):
+        """删除已不在成绩数据中的学生的报告"""
+        self.removed = self.manifest.remove_missing(current_students)
+
+    def finish(self, succeeded):
+        """记录成功生成的报告并保存清单"""
+        self.manifest.template_digest = self.template_digest
+        for student in (set(self.digests) - set(succeeded)) | set(self.failed):
+            self.manifest.forget(student)
+        for student in succeeded:
+            self.manifest.record(student, self.digests[student])
+        self.manifest.save()
+        self.succeeded = list(succeeded)
+
+    def log_summary(self):
+        if self.incremental:
+            logger.info(f"增量生成: 跳过 {len(self.skipped)} 份未变化的报告，重新生成 {len(self.succeeded)} 份，"
+                        f"删除 {len(self.removed)} 份已不存在学生的报告")
+        if self.failed:
+            logger.warning(f"{len(self.failed)} 名学生的报告生成失败: {self.failed}")
+
+
+class MergedCellIndex:
+    """合并单元格索引：每个工作表只建立一次 (行, 列) -> 合并区域左上角 的映射，
+    写入单元格时不必再遍历所有合并区域"""
+
+    def __init__(self, ws):
+        self.anchors = {}
+        for merged_range in ws.merged_cells.ranges:
+            anchor = (merged_range.min_row, merged_range.min_col)
+            for row in range(merged_range.min_row, merged_range.max_row + 1):
+                for col in range(merged_range.min_col, merged_range.max_col + 1):
+                    self.anchors[(row, col)] = anchor
+
+    def anchor(self, row, col):
+        """返回单元格所在合并区域的左上角 (行, 列)，不是合并单元格时返回None"""
+        return self.anchors.get((row, col))
+
+    def resolve(self, row, col):
+        """返回实际应写入的单元格位置：合并单元格返回左上角，否则返回自身"""
+        return self.anchors.get((row, col), (row, col))
+
+
+# {工作表: 合并单元格索引}，工作表被释放后自动移除
+_merged_cell_indexes = weakref.WeakKeyDictionary()
+
+# 公式中的单元格引用，如 C10、$C$10
+CELL_REFERENCE_PATTERN = re.compile(r'(\$?[A-Z]{1,3}\$?)(\d+)')
+
+
+def extend_formula_rows(formula, last_row, extra):
+    """在last_row之后插入extra行后调整公式中本工作表的引用：last_row之后的行号加extra，
+    以last_row结尾的区域（如C3:C10）扩展到插入的最后一行，其余引用不变"""
+    tokenizer = Tokenizer(formula)
+    for token in tokenizer.items:
+        if token.type != Token.OPERAND or token.subtype != Token.RANGE or '!' in token.value:
+            continue
+        parts = token.value.split(':')
+        for position, part in enumerate(parts):
+            match = CELL_REFERENCE_PATTERN.fullmatch(part)
+            if match is None:
+                continue
+            row = int(match.group(2))
+            if row > last_row or (row == last_row and position > 0):
+                parts[position] = f"{match.group(1)}{row + extra}"
+        token.value = ':'.join(parts)
+    return tokenizer.render()
+
+
+def insert_template_rows(ws, before_row, extra):
+    """在模板的before_row之前插入extra个空行：其下的单元格、合并区域和行高一起下移，
+    公式按extend_formula_rows调整，引用插入位置之前最后一行的区域会扩展到新插入的行"""
+    ws.insert_rows(before_row, extra)
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.data_type == 'f' and isinstance(cell.value, str):
+                cell.value = extend_formula_rows(cell.value, before_row - 1, extra)
+    for merged_range in ws.merged_cells.ranges:
+        if merged_range.min_row >= before_row:
+            merged_range.shift(0, extra)
+    for index in sorted((index for index in ws.row_dimensions if index >= before_row), reverse=True):
+        dimension = ws.row_dimensions.pop(index)
+        dimension.index = index + extra
+        ws.row_dimensions[index + extra] = dimension
+    # 合并区域已移动，丢弃之前建立的索引
+    _merged_cell_indexes.pop(ws, None)
+
+
+def get_merged_cell_index(ws):
+    """获取工作表的合并单元格索引，同一工作表只建立一次"""
+    index = _merged_cell_indexes.get(ws)
+    if index is None:
+        index = MergedCellIndex(ws)
+        _merged_cell_indexes[ws] = index
+    return index
+
+
+class TemplatePrototype:
+    """报告模板原型：每次运行只解析一次成绩模板（单元格、合并区域、样式、科目列映射），
+    之后为每个学生从内存快照复制一份独立的工作簿。
+    prepare(ws, template_subjects)在保存快照前对模板工作表调用一次（如应用报告样式），复制出的工作簿都已包含其结果；
+    prepare会因选项不同而改变模板内容时，用variant区分，它会计入模板摘要"""
+
+    def __init__(self, template_path, get_template_subjects, prepare=None, variant=''):
+        wb = load_workbook(template_path)
+        ws = wb.active
+        self.template_path = template_path
+        self.mtime = os.path.getmtime(template_path)
+        self.sheet_title = ws.title
+        self.template_subjects = get_template_subjects(ws)
+        if prepare:
+            prepare(ws, self.template_subjects)
+        # prepare可能插入行、移动合并区域（见insert_template_rows），合并区域在它之后记录
+        self.merged_ranges = [str(merged_range) for merged_range in ws.merged_cells.ranges]
+        self.merged_index = MergedCellIndex(ws)
+        with open(template_path, 'rb') as f:
+            self.digest = hashlib.sha1(f.read() + variant.encode('utf-8')).hexdigest()
+        # 序列化后的工作簿快照，反序列化比重新解析xlsx快得多
+        self._snapshot = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def new_workbook(self):
+        """复制一份与模板内容完全相同的新工作簿"""
+        wb = pickle.loads(self._snapshot)
+        # 副本的合并区域与模板相同，直接复用模板的合并单元格索引
+        _merged_cell_indexes[wb.active] = self.merged_index
+        return wb
+
+
+def _xml_cell(ref, style, value):
+    """按openpyxl的写法生成单元格XML（字符串写为内联字符串），不支持的值（公式、日期等）返回None"""
+    if value is None:
+        return f'<c r="{ref}"{style} t="n" />'
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, NUMERIC_TYPES):
+        return f'<c r="{ref}"{style} t="n"><v>{safe_string(value)}</v></c>'
+    if isinstance(value, str):
+        if (value.startswith('=') and len(value) > 1) or ILLEGAL_CHARACTERS_RE.search(value):
+            return None
+        if value == '':
+            return f'<c r="{ref}"{style} t="inlineStr" />'
+        space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+        return f'<c r="{ref}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+    return None
+
+
+class XmlReportTemplate:
+    """直接写XML的报告模板：把应用好样式的模板副本保存一次，在工作表XML中按单元格切分，
+    生成报告时只替换学生数据所在的单元格，压缩包的其余部分原样复用"""
+
+    cell_pattern = re.compile(r'<c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>.*?</c>)', re.S)
+    style_pattern = re.compile(r'\bs="(\d+)"')
+
+    def __init__(self, package, sheet_path, merged_index):
+        self.sheet_path = sheet_path
+        self.merged_index = merged_index
+
+        with zipfile.ZipFile(io.BytesIO(package)) as source:
+            sheet_xml = source.read(sheet_path).decode('utf-8')
+            # 除工作表外的部分预先写成压缩包，每份报告在它的副本末尾追加工作表
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as base:
+                for info in source.infolist():
+                    if info.filename != sheet_path:
+                        base.writestr(info, source.read(info.filename))
+            self._base = buffer.getvalue()
+
+        # 工作表XML按单元格切分为文本片段，{(行, 列): (片段位置, 单元格引用, 样式属性)}
+        self._chunks = []
+        self._slots = {}
+        position = 0
+        for match in self.cell_pattern.finditer(sheet_xml):
+            self._chunks.append(sheet_xml[position:match.start()])
+            style = self.style_pattern.search(match.group(3))
+            ref = match.group(1) + match.group(2)
+            key = (int(match.group(2)), column_index_from_string(match.group(1)))
+            self._slots[key] = (len(self._chunks), ref, f' s="{style.group(1)}"' if style else '')
+            self._chunks.append(match.group(0))
+            position = match.end()
+        self._chunks.append(sheet_xml[position:])
+
+    def render(self, cells):
+        """生成报告文件内容；有单元格不在模板中或值无法直接写入时返回None，由openpyxl生成"""
+        chunks = list(self._chunks)
+        for row, col, value in cells:
+            # 合并单元格只写入左上角单元格
+            slot = self._slots.get(self.merged_index.resolve(row, col))
+            if slot is None:
+                return None
+            element = _xml_cell(slot[1], slot[2], value)
+            if element is None:
+                return None
+            chunks[slot[0]] = element
+
+        buffer = io.BytesIO(self._base)
+        with zipfile.ZipFile(buffer, 'a', compression=zipfile.ZIP_DEFLATED) as package:
+            package.writestr(self.sheet_path, ''.join(chunks))
+        return buffer.getvalue()
+
+
+class ReportWriter:
+    """报告写入线程：渲染好的报告经有界队列交给后台线程保存，渲染（CPU）和保存（磁盘）同时进行；
+    队列满时提交方等待，内存中最多只有queue_size份待保存的报告"""
+
+    def __init__(self, save, on_saved=None, queue_size=32):
+        # save(report, content) 保存一份报告，on_saved(report) 保存成功后调用
+        self._save = save
+        self._on_saved = on_saved
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.succeeded = []
+        self.failed = []
+        self._thread = threading.Thread(target=self._run, name='ReportWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, report, content):
+        """提交一份渲染好的报告，队列满时等待"""
+        self._queue.put((report, content))
+
+    def close(self):
+        """等待所有报告保存完毕"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            report, content = item
+            try:
+                self._save(report, content)
+            except Exception as e:
+                logger.error(f"保存 {report.student_name} 的报告时出错: {str(e)}")
+                self.failed.append(report.student_name)
+                continue
+            self.succeeded.append(report.student_name)
+            if self._on_saved:
+                self._on_saved(report)
+            if len(self.succeeded) % 10 == 0:
+                logger.info(f"已生成 {len(self.succeeded)} 份报告...")
+
+
 class GradeSummaryGenerator:
-    def __init__(self):
+    # 报告的生成方式：openpyxl为每份报告建立工作簿对象，xml直接替换模板工作表中的单元格
+    engines = ['openpyxl', 'xml']
+    # 报告的输出方式：每名学生一个文件、一个zip压缩包、一个多工作表的工作簿
+    output_modes = ['files', 'zip', 'workbook']
+    # 渲染好等待写入的报告数上限，限制内存占用
+    pipeline_queue_size = 32
+
+    def __init__(self, loader=None, engine='openpyxl', percentiles=False):
+        # 成绩文件加载器，可与GradeBefore200共用以避免重复解析
+        self.loader = loader or GradeLoader()
+        self.engine = engine
+        # 在报告中添加各科成绩的年级百分位列（取自加载器的成绩统计，见CohortStatistics）
+        self.percentiles = percentiles
+
         # 科目定义
         self.grade7_subjects = ['语文', '数学', '英语', '地理', '生物', '历史', '政治']
         self.grade8_subjects = ['语文', '数学', '英语', '地理', '生物', '历史', '政治', '物理', '化学']
@@ -27,268 +1852,213 @@ class GradeSummaryGenerator:
             bottom=Side(style='thin')
         )
         self.center_alignment = Alignment(horizontal='center', vertical='center')
+
+        # 数据从第3行开始填充（学期从B3开始向下分布）
+        self.data_start_row = 3
+        # 百分位列从第15列（O列）开始，排在排名之后
+        self.percentile_start_column = 15
+        # 学期表与加载器相同，每个学期占一行
+        self.semesters = self.loader.semesters
+
+        # 运行期间复用的模板原型，以及由原型生成的XML模板
+        self._template_prototypes = {}
+        self._xml_templates = weakref.WeakKeyDictionary()
         
     def load_all_grades(self, data_dir):
         """加载所有成绩文件（支持.xls和.xlsx格式）"""
-        all_files = []
-        # 获取所有.xlsx文件
-        all_files.extend(glob.glob(os.path.join(data_dir, "*.xlsx")))
-        # 获取所有.xls文件
-        all_files.extend(glob.glob(os.path.join(data_dir, "*.xls")))
-        
-        all_data = {}
-        
-        # 定义8个学期的完整列表，确保能识别所有学期
-        semester_keys = ['初一上期中', '初一上期末', '初一下期中', '初一下期末', 
-                         '初二上期中', '初二上期末', '初二下期中', '初二下期末', '初三上期中']
-        
-        for file in all_files:
-            try:
-                # 从文件名中提取学期和考试类型信息
-                filename = os.path.basename(file)
-                grade = None
-                semester = None
-                exam_type = None
-                
-                # 首先尝试精确匹配完整的学期键
-                matched = False
-                for key in semester_keys:
-                    if key in filename:
-                        grade = key[:2]  # 提取年级
-                        semester = key[2:3]  # 提取学期(上/下)
-                        exam_type = key[3:]  # 提取考试类型(期中/期末)
-                        matched = True
-                        break
-                
-                if not matched:
-                    # 尝试传统的分步提取方式
-                    # 提取年级信息
-                    if "初一" in filename:
-                        grade = "初一"
-                    elif "初二" in filename:
-                        grade = "初二"
-                    elif "初三" in filename:
-                        grade = "初三"
-                    
-                    # 提取学期信息
-                    if "上" in filename:
-                        semester = "上"
-                    elif "下" in filename:
-                        semester = "下"
-                    
-                    # 提取考试类型信息
-                    if "期中" in filename:
-                        exam_type = "期中"
-                    elif "期末" in filename:
-                        exam_type = "期末"
-                
-                if not grade or not semester or not exam_type:
-                    print(f"无法从文件名 {filename} 中提取完整信息，跳过此文件")
-                    continue
-                
-                key = f"{grade}{semester}{exam_type}"
-                
-                # 尝试读取Excel文件
-                try:
-                    df = pd.read_excel(file)
-                    all_data[key] = df
-                    print(f"成功加载: {key} - {filename}")
-                except ImportError as e:
-                    if 'xlrd' in str(e):
-                        print(f"加载文件 {file} 时出错: 需要安装xlrd库来读取.xls文件。请运行: pip install xlrd")
-                    else:
-                        print(f"加载文件 {file} 时出错: {str(e)}")
-                except Exception as e:
-                    print(f"加载文件 {file} 时出错: {str(e)}")
-            except Exception as e:
-                print(f"处理文件 {file} 时出错: {str(e)}")
-        
-        # 打印加载的所有学期信息，方便调试
-        print(f"成功加载的学期数据: {list(all_data.keys())}")
-        return all_data
+        return self.loader.load_all_grades(data_dir)
     
     def get_student_names(self, all_data):
         """从所有数据中提取所有学生姓名"""
-        all_students = set()
-        
-        for df_key, df in all_data.items():
-            try:
-                # 尝试多种可能的姓名列名
-                name_column_found = False
-                
-                # 尝试直接匹配'姓名'列
-                if '姓名' in df.columns:
-                    student_names = df['姓名'].dropna().astype(str).tolist()
-                    all_students.update([name.strip() for name in student_names if name.strip()])
-                    name_column_found = True
-                else:
-                    # 尝试包含'姓名'的列
-                    name_columns = [col for col in df.columns if '姓名' in str(col) or '名字' in str(col)]
-                    if name_columns:
-                        for col in name_columns:
-                            try:
-                                student_names = df[col].dropna().astype(str).tolist()
-                                all_students.update([name.strip() for name in student_names if name.strip()])
-                                name_column_found = True
-                                break  # 找到一个合适的列就够了
-                            except:
-                                continue
-                
-                if not name_column_found:
-                    print(f"在文件 {df_key} 中未找到包含学生姓名的列")
-            except Exception as e:
-                print(f"提取文件 {df_key} 中的学生姓名时出错: {str(e)}")
-        
-        return all_students
-    
+        return set(self.get_grade_store(all_data).students)
+
+    def get_grade_store(self, all_data):
+        """获取成绩库，同一份成绩数据只整理一次"""
+        return self.loader.get_store(all_data)
+
+    def get_student_index(self, all_data):
+        """获取学生索引（随成绩库一起建立）"""
+        return self.get_grade_store(all_data).index
+
+    def get_template_prototype(self, template_path):
+        """获取模板原型，模板文件未修改时复用已解析的结果"""
+        key = os.path.abspath(template_path)
+        prototype = self._template_prototypes.get(key)
+        if prototype is None or prototype.mtime != os.path.getmtime(template_path):
+            # 百分位列和学期行数（可能需要插入行，见fit_semester_rows）都会改变模板原型
+            variant = f"{'percentiles' if self.percentiles else ''}:{len(self.semesters)}"
+            prototype = TemplatePrototype(template_path, self._get_template_subjects, self._style_template, variant)
+            self._template_prototypes[key] = prototype
+            logger.info(f"从模板中识别的科目映射: {prototype.template_subjects}")
+        return prototype
+
+    def _style_template(self, ws, template_subjects):
+        """在模板原型上应用一次报告样式（以及百分位列的表头），之后每份报告只需写入单元格的值"""
+        self.fit_semester_rows(ws)
+        percentile_columns = self.percentile_columns(template_subjects)
+        for subject, col in percentile_columns.items():
+            ws.cell(row=2, column=col, value=f"{subject}百分位")
+        self.apply_styles(ws, self.data_start_row, len(self.semesters), max(percentile_columns.values(), default=15))
+
+    def template_semester_rows(self, ws):
+        """模板中可以填写学期的行数：从data_start_row开始，到第一行有学期名称以外内容的行（如“参考数”）为止；
+        之后没有这样的行时返回None（行数不限）"""
+        merged_index = get_merged_cell_index(ws)
+        for row in range(self.data_start_row, ws.max_row + 1):
+            for col in range(1, ws.max_column + 1):
+                value = ws.cell(row=row, column=col).value
+                is_label = col == 2 and isinstance(value, str) and value.strip().endswith(tuple(SCHEDULE_EXAMS))
+                if (value is not None and not is_label) or merged_index.anchor(row, col) is not None:
+                    return row - self.data_start_row
+        return None
+
+    def fit_semester_rows(self, ws):
+        """学期表的学期数多于模板的学期行时，在学期行之后插入行，把参考数、最高分等内容整体下移，
+        避免学期数据覆盖这些内容（或把模板中的数值当作学生的成绩）"""
+        free_rows = self.template_semester_rows(ws)
+        if free_rows is None or len(self.semesters) <= free_rows:
+            return
+        extra = len(self.semesters) - free_rows
+        logger.warning(f"学期表有 {len(self.semesters)} 个学期，而模板只有 {free_rows} 行学期，"
+                       f"已在第{self.data_start_row + free_rows}行之前插入 {extra} 行，其后的内容整体下移")
+        insert_template_rows(ws, self.data_start_row + free_rows, extra)
+
+    def percentile_columns(self, template_subjects):
+        """百分位列，{科目: 列号}：模板中的各科目和总分，未启用百分位时为空"""
+        if not self.percentiles:
+            return {}
+        subjects = list(template_subjects) + ['总分']
+        return {subject: self.percentile_start_column + i for i, subject in enumerate(subjects)}
+
+    def get_xml_template(self, prototype):
+        """获取XML模板：已带样式的模板原型保存一次，之后每份报告只替换单元格"""
+        xml_template = self._xml_templates.get(prototype)
+        if xml_template is None:
+            wb = prototype.new_workbook()
+            ws = wb.active
+            buffer = io.BytesIO()
+            wb.save(buffer)
+            # openpyxl按工作表顺序命名为sheet1.xml、sheet2.xml……
+            sheet_path = f"xl/worksheets/sheet{wb.worksheets.index(ws) + 1}.xml"
+            xml_template = XmlReportTemplate(buffer.getvalue(), sheet_path, prototype.merged_index)
+            self._xml_templates[prototype] = xml_template
+        return xml_template
+
     def is_merged_cell(self, ws, cell):
         """检查单元格是否是合并单元格的一部分"""
-        for merged_cell in ws.merged_cells.ranges:
-            if cell.coordinate in merged_cell:
-                # 如果是合并单元格，返回左上角的单元格坐标
-                return merged_cell.start_cell.coordinate
+        anchor = get_merged_cell_index(ws).anchor(cell.row, cell.column)
+        if anchor:
+            # 如果是合并单元格，返回左上角的单元格坐标
+            return ws.cell(row=anchor[0], column=anchor[1]).coordinate
         return False
     
     def safe_write_cell(self, ws, row, col, value):
         """安全地写入单元格，处理合并单元格的情况"""
         try:
-            # 首先获取单元格对象
-            target_cell = ws.cell(row=row, column=col)
-            # 检查是否是合并单元格
-            merged_start_cell = self.is_merged_cell(ws, target_cell)
-            if merged_start_cell:
-                # 如果是合并单元格，只写入左上角单元格
-                ws[merged_start_cell] = value
-            else:
-                # 不是合并单元格，直接写入
-                target_cell.value = value
+            # 如果是合并单元格，只写入左上角单元格
+            row, col = get_merged_cell_index(ws).resolve(row, col)
+            ws.cell(row=row, column=col).value = value
             return True
         except Exception as e:
             # 捕获所有可能的错误，如只读单元格等
-            print(f"写入单元格({row}, {col})时出错: {str(e)}")
+            logger.error(f"写入单元格({row}, {col})时出错: {str(e)}")
             return False
     
+    def build_student_cells(self, student_name, all_data, template_subjects):
+        """从成绩库中提取单个学生报告需要写入的所有单元格，不涉及工作簿操作"""
+        with timings.stage('个人报告/查询成绩'):
+            return self._build_student_cells(student_name, all_data, template_subjects)
+
+    def iter_student_cells(self, students, all_data, template_subjects, failed=None):
+        """依次提取多名学生的报告内容；某名学生出错时记录错误并跳过，不影响其他学生，出错的学生追加到failed"""
+        for student in students:
+            try:
+                report = self.build_student_cells(student, all_data, template_subjects)
+            except Exception as e:
+                logger.error(f"生成 {student} 的报告时出错: {str(e)}")
+                if failed is not None:
+                    failed.append(student)
+                continue
+            yield report
+
+    def _build_student_cells(self, student_name, all_data, template_subjects):
+        report = StudentReport(student_name, len(self.semesters))
+
+        # 设置学生姓名
+        report.cells.append((2, 2, student_name))  # B2单元格
+
+        # 学期表中的所有学期
+        semesters = self.semesters
+
+        record = self.get_grade_store(all_data).student_record(student_name)
+        percentile_columns = self.percentile_columns(template_subjects)
+        percentiles = {}
+        if percentile_columns:
+            percentiles = self.loader.get_statistics(all_data).student_percentiles(student_name)
+
+        for i, semester in enumerate(semesters):
+            # 计算当前学期应该填充的行号（学期从B3开始向下分布）
+            current_row = self.data_start_row + i
+            logger.debug("正在处理 %s 的 %s 数据，填充到行 %d", student_name, semester, current_row)
+
+            # 即使没有数据，也填写学期名称，确保位置正确
+            report.cells.append((current_row, 2, semester))  # B列
+
+            # 检查数据是否存在
+            if semester not in all_data:
+                logger.debug("未找到 %s 的数据，将填充空行", semester)
+                continue
+
+            exam = record.get(semester)
+            if exam is None:
+                logger.debug("未找到 %s 在 %s 中的数据", student_name, semester)
+                continue
+
+            # 按模板科目的列位置填充成绩
+            filled_subjects = 0
+            for template_subject, col_idx in template_subjects.items():
+                value = exam['subjects'].get(template_subject)
+                if value is None:
+                    continue
+                report.cells.append((current_row, col_idx, value))
+                filled_subjects += 1
+                logger.debug("成功填充: %s -> 单元格(%d, %d)", template_subject, current_row, col_idx)
+
+            logger.debug("成功填充了 %d 个科目数据", filled_subjects)
+            report.found_semesters += 1
+            report.filled_subjects += filled_subjects
+
+            # 填写校排名和班排名
+            self._fill_rank_data(report.cells, current_row, exam)
+
+            # 填写各科成绩的年级百分位
+            for subject, value in percentiles.get(semester, {}).items():
+                if subject in percentile_columns:
+                    report.cells.append((current_row, percentile_columns[subject], round(value, 1)))
+
+        return report
+
+    def render_student_report(self, report, prototype):
+        """把提取好的单元格写入模板副本（样式已在模板原型中应用），返回工作簿"""
+        with timings.stage('个人报告/复制模板'):
+            wb = prototype.new_workbook()
+            ws = wb.active
+        with timings.stage('个人报告/填充单元格'):
+            for row, col, value in report.cells:
+                # 使用安全写入方法
+                self.safe_write_cell(ws, row, col, value)
+        return wb
+
     def create_student_report(self, student_name, all_data, template_path, output_dir):
         """为单个学生创建报告"""
         try:
-            # 加载模板
-            wb = load_workbook(template_path)
-            ws = wb.active
-            
-            # 设置学生姓名 - 使用安全写入方法
-            self.safe_write_cell(ws, 2, 2, student_name)  # B2单元格
-            
-            # 定义数据位置 - 从第3行开始填充数据（学期从B3开始向下分布）
-            data_start_row = 3
-            
-            # 包含期中期末的所有学期
-            semesters = ['初一上期中', '初一上期末', '初一下期中', '初一下期末', 
-                         '初二上期中', '初二上期末', '初二下期中', '初二下期末', '初三上期中']
-            
-            # 核心改进：使用模板中的科目名称作为基准，建立精确的映射关系
-            template_subjects = self._get_template_subjects(ws)
-            print(f"从模板中识别的科目映射: {template_subjects}")
-            
-            for i, semester in enumerate(semesters):
-                # 计算当前学期应该填充的行号
-                current_row = data_start_row + i
-                print(f"\n正在处理 {student_name} 的 {semester} 数据，填充到行 {current_row}")
-                
-                # 检查数据是否存在
-                if semester not in all_data:
-                    print(f"警告: 未找到 {semester} 的数据，将填充空行")
-                    # 即使没有数据，也填写学期名称，确保位置正确
-                    self.safe_write_cell(ws, current_row, 2, semester)  # B列
-                    continue
-                
-                df = all_data[semester]
-                student_data = None
-                
-                # 查找学生数据 - 增强匹配逻辑
-                name_columns_to_try = []
-                # 先检查是否有'姓名'列
-                if '姓名' in df.columns:
-                    name_columns_to_try.append('姓名')
-                # 再检查包含'姓名'或'名字'的列
-                name_columns_to_try.extend([col for col in df.columns if '姓名' in str(col) or '名字' in str(col)])
-                
-                # 如果没有找到明显的姓名列，尝试所有可能的字符串列
-                if not name_columns_to_try:
-                    for col in df.columns:
-                        try:
-                            # 检查该列是否包含字符串类型的数据
-                            if df[col].dtype == 'object' or isinstance(df[col].iloc[0], str):
-                                name_columns_to_try.append(col)
-                        except:
-                            continue
-                
-                print(f"尝试的姓名列: {name_columns_to_try}")
-                
-                for col in name_columns_to_try:
-                    try:
-                        # 增强匹配逻辑，使用更灵活的字符串比较
-                        student_data = df[df[col].astype(str).str.strip().str.contains(student_name, case=False, na=False)]
-                        if not student_data.empty:
-                            print(f"在列 '{col}' 中找到学生 '{student_name}'")
-                            break
-                    except Exception as e:
-                        print(f"在列 '{col}' 中查找时出错: {str(e)}")
-                        continue
-                
-                if student_data is None or student_data.empty:
-                    # 没有找到该学生的数据，也要填写学期名称
-                    print(f"警告: 未找到 {student_name} 在 {semester} 中的数据")
-                    self.safe_write_cell(ws, current_row, 2, semester)  # B列
-                    continue
-                
-                row = student_data.iloc[0]
-                
-                # 填写学期 - 使用安全写入方法
-                self.safe_write_cell(ws, current_row, 2, semester)  # B列
-                
-                # 核心改进：根据模板科目名称建立数据列映射
-                data_columns_mapping = self._map_data_columns(df.columns, template_subjects.keys())
-                print(f"数据列映射关系: {data_columns_mapping}")
-                
-                # 改进的科目填充逻辑 - 精确填充
-                filled_subjects = 0
-                for template_subject, col_idx in template_subjects.items():
-                    # 检查该科目是否在数据列映射中
-                    if template_subject in data_columns_mapping:
-                        data_col = data_columns_mapping[template_subject]
-                        try:
-                            if pd.notna(row[data_col]):
-                                # 确保写入的是数值类型
-                                value = row[data_col]
-                                try:
-                                    value = float(value)
-                                except:
-                                    print(f"警告: {data_col} 的值 '{value}' 无法转换为数值")
-                                # 使用安全写入方法
-                                self.safe_write_cell(ws, current_row, col_idx, value)
-                                filled_subjects += 1
-                                print(f"成功填充: {template_subject} -> 列 '{data_col}' -> 单元格({current_row}, {col_idx})")
-                        except Exception as e:
-                            print(f"填充 {template_subject} 时出错: {str(e)}")
-                    else:
-                        print(f"警告: 数据中没有找到与模板科目 '{template_subject}' 对应的列")
-                
-                print(f"成功填充了 {filled_subjects} 个科目数据")
-                
-                # 填写校排名和班排名
-                self._fill_rank_data(ws, current_row, row)
-            
-            # 应用样式
-            self.apply_styles(ws, data_start_row, len(semesters))
-            
-            # 保存文件
-            output_path = os.path.join(output_dir, f"{student_name}_成绩总结.xlsx")
-            wb.save(output_path)
-            return True
-            
+            # 从模板原型复制工作簿（模板每次运行只解析一次）
+            prototype = self.get_template_prototype(template_path)
+            report = self.build_student_cells(student_name, all_data, prototype.template_subjects)
         except Exception as e:
-            print(f"生成 {student_name} 的报告时出错: {str(e)}")
+            logger.error(f"生成 {student_name} 的报告时出错: {str(e)}")
             return False
+        return self.save_student_report(report, prototype, output_dir)
             
     def _get_template_subjects(self, ws):
         """从模板中提取科目名称及其对应的列索引，根据用户提供的模板结构：科目在C列2行横向排列"""
@@ -299,7 +2069,7 @@ class GradeSummaryGenerator:
         start_col = 3   # 科目从第3列（C列）开始
         
         # 定义标准科目名称列表，用于验证
-        standard_subjects = {'语文', '数学', '英语', '地理', '生物', '历史', '政治', '物理', '化学', '总分'}
+        standard_subjects = set(STANDARD_SUBJECTS)
         
         # 从第3列（C列）开始向右查找科目名称，最多检查到第15列
         for col_idx in range(start_col, 16):
@@ -313,15 +2083,15 @@ class GradeSummaryGenerator:
                 # 添加到模板科目映射中
                 if clean_subject in standard_subjects:
                     template_subjects[clean_subject] = col_idx
-                    print(f"识别科目: '{clean_subject}' 在单元格({header_row}, {col_idx})")
+                    logger.debug("识别科目: '%s' 在单元格(%d, %d)", clean_subject, header_row, col_idx)
             # 如果单元格为空，且已经找到了至少一个科目，可能是科目列表结束
             elif template_subjects and col_idx > start_col:
-                print(f"遇到空单元格，停止查找科目")
+                logger.debug("遇到空单元格，停止查找科目")
                 break
         
         # 如果没有找到任何科目，使用默认映射
         if not template_subjects:
-            print("未从模板中识别到科目，使用默认映射")
+            logger.warning("未从模板中识别到科目，使用默认映射")
             # 默认映射：从第3列（C列）开始依次排列标准科目
             default_subjects = ['语文', '数学', '英语', '物理', '政治', '历史', '生物', '地理', '化学', '总分']
             template_subjects = {subject: start_col + i for i, subject in enumerate(default_subjects)}
@@ -350,137 +2120,51 @@ class GradeSummaryGenerator:
 
     def _map_data_columns(self, data_columns, template_subjects):
         """将数据列与模板科目进行精确映射"""
-        mapping = {}
-        
-        # 为每个模板科目查找匹配的数据列
-        for subject in template_subjects:
-            # 创建匹配模式
-            patterns = [
-                subject,
-                f"{subject}成绩", f"{subject}分数", f"{subject}得分", f"{subject}分",
-                f"期中{subject}", f"期末{subject}", f"{subject}期中", f"{subject}期末"
-            ]
-
-            if subject == "总分":
-                patterns.extend(["总分", "总分成绩", "总分分数", "总分得分", "总分分", "总分数", "总成绩"])
-            
-            # 查找匹配的列
-            matched_column = self._find_matching_column(data_columns, patterns)
-            if matched_column:
-                mapping[subject] = matched_column
-        
-        return mapping
-        
+        return map_subject_columns(data_columns, template_subjects)
+
     def _find_matching_column(self, columns, patterns):
-        """在列列表中查找与任何模式匹配的列"""
-        # 首先尝试精确匹配
-        for col in columns:
-            col_str = str(col).strip()
-            for pattern in patterns:
-                if col_str == pattern or col_str.lower() == pattern.lower():
-                    return col
-        
-        # 然后尝试包含匹配
-        for col in columns:
-            col_str = str(col).strip().lower()
-            for pattern in patterns:
-                if pattern.lower() in col_str:
-                    return col
-        
-        return None
-        
-    def _fill_rank_data(self, ws, current_row, row_data):
-        """填充排名数据"""
-        # 定义排名类型和对应的列索引
-        rank_types = {
-            '校排名': 14,  # 校排名在第11列
-            '班排名': 13   # 班排名在第12列
-        }
-        
-        # 填充校排名
-        school_rank_found = False
-        school_rank_variants = ['校排名', '校名次', '序号', '校次']
-        for variant in school_rank_variants:
-            if variant in row_data.index:
-                try:
-                    if pd.notna(row_data[variant]):
-                        value = row_data[variant]
-                        try:
-                            value = int(value)
-                        except:
-                            pass
-                        self.safe_write_cell(ws, current_row, rank_types['校排名'], value)
-                        print(f"填充校排名: 从列 '{variant}' 获取值 '{value}'")
-                        school_rank_found = True
-                        break
-                except Exception as e:
-                    print(f"填充校排名时出错: {str(e)}")
-        
-        if not school_rank_found:
-            print("未找到校排名数据")
-        
-        # 填充班排名
-        class_rank_found = False
-        class_rank_variants = ['班排名', '班名次', '班级排名', '班级名次']
-        for variant in class_rank_variants:
-            if variant in row_data.index:
-                try:
-                    if pd.notna(row_data[variant]):
-                        value = row_data[variant]
-                        try:
-                            value = int(value)
-                        except:
-                            pass
-                        self.safe_write_cell(ws, current_row, rank_types['班排名'], value)
-                        print(f"填充班排名: 从列 '{variant}' 获取值 '{value}'")
-                        class_rank_found = True
-                        break
-                except Exception as e:
-                    print(f"填充班排名时出错: {str(e)}")
-        
-        if not class_rank_found:
-            print("未找到班排名数据")
-            
-            # 新增：填充总分数据（固定在第12列，L列）- 移到正确位置
-        total_score_found = False
-        total_score_variants = ['总分', '总分成绩', '总分分数', '总分得分', '总分分', '总分数', '总成绩']
-            
-        for variant in total_score_variants:
-            if variant in row_data.index:
-                try:
-                    if pd.notna(row_data[variant]):
-                        value = row_data[variant]
-                        try:
-                            value = float(value)
-                        except:
-                            pass
-                            # 总分固定在第12列（L列）
-                        self.safe_write_cell(ws, current_row, 12, value)
-                        print(f"填充总分: 从列 '{variant}' 获取值 '{value}' -> 单元格({current_row}, 12)")
-                        total_score_found = True
-                        break
-                except Exception as e:
-                    print(f"填充总分时出错: {str(e)}")
-            
-        if not total_score_found:
-            print("未找到总分数据")
+        """在列列表中查找与任何模式匹配的列"""
+        return find_matching_column(columns, patterns)
 
-    def apply_styles(self, ws, start_row, row_count):
-        """应用样式到工作表，避免处理合并单元格"""
-        # 创建一个合并单元格坐标的集合，用于快速检查
-        merged_cells_coords = set()
-        for merged_range in ws.merged_cells.ranges:
-            # 获取合并区域内的所有单元格坐标
-            for row in range(merged_range.min_row, merged_range.max_row + 1):
-                for col in range(merged_range.min_col, merged_range.max_col + 1):
-                    cell = ws.cell(row=row, column=col)
-                    merged_cells_coords.add(cell.coordinate)
+    def _fill_rank_data(self, cells, current_row, exam):
+        """提取排名和总分数据，追加到待写入的单元格列表"""
+        # 定义排名类型和对应的列索引
+        rank_types = {
+            '校排名': 14,  # 校排名在第14列（N列）
+            '班排名': 13   # 班排名在第13列（M列）
+        }
+
+        # 填充校排名
+        if exam['school_rank'] is not None:
+            cells.append((current_row, rank_types['校排名'], int(exam['school_rank'])))
+            logger.debug("填充校排名: %d", exam['school_rank'])
+        else:
+            logger.debug("未找到校排名数据")
+
+        # 填充班排名
+        if exam['class_rank'] is not None:
+            cells.append((current_row, rank_types['班排名'], int(exam['class_rank'])))
+            logger.debug("填充班排名: %d", exam['class_rank'])
+        else:
+            logger.debug("未找到班排名数据")
+
+        # 填充总分数据（固定在第12列，L列）
+        if exam['total_score'] is not None:
+            cells.append((current_row, 12, exam['total_score']))
+            logger.debug("填充总分: %s -> 单元格(%d, 12)", exam['total_score'], current_row)
+        else:
+            logger.debug("未找到总分数据")
+
+    def apply_styles(self, ws, start_row, row_count, last_column=15):
+        """应用样式到工作表，避免处理合并单元格；last_column为需要设置样式的最后一列"""
+        # 使用合并单元格索引快速检查
+        merged_index = get_merged_cell_index(ws)
         
         # 关键修改：设置标题行样式 - 科目在第2行（row=2）
-        for col in range(1, 16):  # 增加列范围以覆盖所有科目列
-            cell = ws.cell(row=2, column=col)  # 标题行改为第2行
+        for col in range(1, max(last_column, 15) + 1):  # 增加列范围以覆盖所有科目列
             # 跳过合并单元格
-            if cell.coordinate not in merged_cells_coords:
+            if merged_index.anchor(2, col) is None:
+                cell = ws.cell(row=2, column=col)  # 标题行改为第2行
                 # 移除cell.fill = self.header_fill 这一行，取消黄色填充
                 cell.font = self.header_font
                 cell.border = self.border
@@ -488,10 +2172,10 @@ class GradeSummaryGenerator:
         
         # 设置数据区域样式
         for row in range(start_row, start_row + row_count):
-            for col in range(1, 16):  # 增加列范围以覆盖所有科目列
-                cell = ws.cell(row=row, column=col)
+            for col in range(1, max(last_column, 15) + 1):  # 增加列范围以覆盖所有科目列
                 # 跳过合并单元格
-                if cell.coordinate not in merged_cells_coords:
+                if merged_index.anchor(row, col) is None:
+                    cell = ws.cell(row=row, column=col)
                     try:
                         cell.border = self.border
                         cell.alignment = self.center_alignment
@@ -499,40 +2183,329 @@ class GradeSummaryGenerator:
                         # 忽略样式应用错误
                         pass
     
-    def generate_all_reports(self, data_dir, template_path, output_dir):
-        """生成所有学生的报告"""
-        # 创建输出目录
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
+    def generate_all_reports(self, data_dir, template_path, output_dir, jobs=1, incremental=True,
+                             output_mode='files'):
+        """生成所有学生的报告，jobs大于1时使用多个进程并行生成；
+        incremental为True时跳过内容和模板都没有变化的报告。
+        output_mode为zip时所有报告写入 output_dir.zip，为workbook时写入 output_dir.xlsx（每名学生一个工作表），
+        这两种方式每次都完整重新生成"""
+        with timings.stage('个人报告'):
+            return self._generate_all_reports(data_dir, template_path, output_dir, jobs, incremental, output_mode)
+
+    def prepare_reports(self, data_dir, template_path):
+        """加载成绩数据、建立成绩库并解析模板，返回 (成绩数据, 学生姓名集合, 模板原型)；
+        没有成绩数据或学生时返回None"""
         # 加载所有成绩数据
         all_data = self.load_all_grades(data_dir)
         
         if not all_data:
-            print("未找到任何成绩文件!")
-            return
+            logger.error("未找到任何成绩文件!")
+            return None
         
         # 获取所有学生姓名
         all_students = self.get_student_names(all_data)
         
         if not all_students:
-            print("未找到任何学生姓名，请检查成绩文件格式")
-            return
-        
-        print(f"找到 {len(all_students)} 名学生")
+            logger.error("未找到任何学生姓名，请检查成绩文件格式")
+            return None
         
+        logger.info(f"找到 {len(all_students)} 名学生")
+
+        # 成绩库随学生姓名一起建立，提示重复或存在包含关系的姓名
+        store = self.get_grade_store(all_data)
+        store.index.report_ambiguities()
+
+        # 打印每个学期的列映射，以便核对每个成绩文件的解析结果
+        prototype = self.get_template_prototype(template_path)
+        for schema in store.schemas.values():
+            logger.info(schema)
+            missing = [subject for subject in prototype.template_subjects if subject not in schema.subject_columns]
+            if missing:
+                logger.info(f"  未找到对应列的模板科目: {missing}")
+        return all_data, all_students, prototype
+
+    def _generate_all_reports(self, data_dir, template_path, output_dir, jobs, incremental, output_mode):
+        # 创建输出目录
+        if output_mode == 'files' and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        prepared = self.prepare_reports(data_dir, template_path)
+        if prepared is None:
+            return
+        all_data, all_students, prototype = prepared
+
+        # 所有报告写入一个文件，按顺序一次写完
+        if output_mode != 'files':
+            if jobs and jobs > 1:
+                logger.info("打包输出时在当前进程中依次生成报告")
+            # 报告逐个提取、渲染和写入，内存占用不随学生人数增长
+            failed = []
+            reports = self.iter_student_cells(sorted(all_students), all_data, prototype.template_subjects, failed)
+            output_path = output_dir.rstrip('/\\') + ('.zip' if output_mode == 'zip' else '.xlsx')
+            if output_mode == 'zip':
+                count = self.write_report_archive(reports, prototype, output_path)
+            else:
+                count = self.write_report_workbook(reports, prototype, output_path)
+            logger.info(f"成功生成 {count} 份学生成绩报告，保存在 {output_path} 中")
+            if failed:
+                logger.warning(f"{len(failed)} 名学生的报告生成失败: {failed}")
+            return
+
+        # 增量生成时与上次的清单对比，只重新生成有变化的报告
+        plan = ReportPlan(output_dir, prototype.digest, incremental)
+        changed_reports = plan.changed(self.iter_student_cells(sorted(all_students), all_data,
+                                                               prototype.template_subjects, plan.failed))
+
+        # 删除已不在成绩数据中的学生的报告
+        plan.remove_missing(all_students)
+
         # 为每名学生生成报告
-        success_count = 0
-        for student in all_students:
-            if self.create_student_report(student, all_data, template_path, output_dir):
-                success_count += 1
-                if success_count % 10 == 0:
-                    print(f"已生成 {success_count} 份报告...")
-        
-        print(f"成功生成 {success_count} 份学生成绩报告，保存在 {output_dir} 目录中")
+        if jobs is not None and jobs <= 0:
+            jobs = os.cpu_count() or 1
+        if jobs and jobs > 1:
+            # 报告内容在计算增量哈希时已经提取，直接交给工作进程渲染和保存，不再重复提取
+            reports = list(changed_reports)
+            if len(reports) > 1:
+                succeeded = self._generate_reports_parallel(reports, prototype, output_dir, jobs)
+            else:
+                succeeded = self._generate_reports_serial(reports, prototype, output_dir)
+        else:
+            succeeded = self._generate_reports_serial(changed_reports, prototype, output_dir)
+
+        plan.finish(succeeded)
+        logger.info(f"成功生成 {len(succeeded)} 份学生成绩报告，保存在 {output_dir} 目录中")
+        plan.log_summary()
+        return succeeded
+
+    def render_student_report_bytes(self, report, prototype):
+        """渲染已提取好内容的学生报告，返回.xlsx文件内容"""
+        content = None
+        if self.engine == 'xml' and report.semester_count == len(self.semesters):
+            xml_template = self.get_xml_template(prototype)
+            with timings.stage('个人报告/XML渲染'):
+                content = xml_template.render(report.cells)
+        if content is None:
+            wb = self.render_student_report(report, prototype)
+            buffer = io.BytesIO()
+            with timings.stage('个人报告/保存工作簿'):
+                wb.save(buffer)
+            content = buffer.getvalue()
+        return content
+
+    def _log_report_summary(self, report):
+        """每名学生一行摘要"""
+        logger.info(f"{report.student_name}: 找到 {report.found_semesters}/{report.semester_count} 个学期的数据，"
+                    f"填充 {report.filled_subjects} 个科目成绩")
+
+    def save_student_report(self, report, prototype, output_dir):
+        """渲染并保存已提取好内容的学生报告"""
+        try:
+            content = self.render_student_report_bytes(report, prototype)
+            with timings.stage('个人报告/写入文件'):
+                with open(os.path.join(output_dir, report_filename(report.student_name)), 'wb') as f:
+                    f.write(content)
+            self._log_report_summary(report)
+            return True
+        except Exception as e:
+            logger.error(f"生成 {report.student_name} 的报告时出错: {str(e)}")
+            return False
+
+    def write_report_archive(self, reports, prototype, archive_path):
+        """把所有报告依次写入一个zip压缩包，返回成功写入的报告数。
+        .xlsx本身已经压缩，压缩包中按存储方式保存，不再二次压缩"""
+        temp_path = archive_path + '.tmp'
+        with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+            def save(report, content):
+                with timings.stage('个人报告/写入压缩包'):
+                    archive.writestr(report_filename(report.student_name), content)
+
+            with ReportWriter(save, self._log_report_summary, self.pipeline_queue_size) as writer:
+                self._render_reports(reports, prototype, writer)
+        os.replace(temp_path, archive_path)
+        return len(writer.succeeded)
+
+    def write_report_workbook(self, reports, prototype, workbook_path):
+        """把所有报告写入同一个工作簿，每名学生一个工作表，返回成功写入的报告数"""
+        wb = prototype.new_workbook()
+        source = wb.active
+        # 模板原型已带样式，复制出的工作表都带有相同的样式
+        for ws in list(wb.worksheets):
+            if ws is not source:
+                wb.remove(ws)
+
+        used_titles = set()
+        count = 0
+        for report in reports:
+            with timings.stage('个人报告/复制工作表'):
+                ws = wb.copy_worksheet(source)
+            try:
+                ws.title = sheet_title(report.student_name, used_titles)
+                with timings.stage('个人报告/填充单元格'):
+                    for row, col, value in report.cells:
+                        self.safe_write_cell(ws, row, col, value)
+            except Exception as e:
+                logger.error(f"生成 {report.student_name} 的报告时出错: {str(e)}")
+                wb.remove(ws)
+                continue
+            self._log_report_summary(report)
+            count += 1
+            if count % 10 == 0:
+                logger.info(f"已生成 {count} 份报告...")
+
+        wb.remove(source)
+        if wb.worksheets:
+            wb.active = 0
+        temp_path = workbook_path + '.tmp'
+        with timings.stage('个人报告/保存工作簿'):
+            wb.save(temp_path)
+        os.replace(temp_path, workbook_path)
+        return count
+
+    def _render_reports(self, reports, prototype, writer):
+        """依次渲染报告并交给写入线程；写入线程的队列满时在这里等待，渲染和写入同时进行"""
+        for report in reports:
+            try:
+                content = self.render_student_report_bytes(report, prototype)
+            except Exception as e:
+                logger.error(f"生成 {report.student_name} 的报告时出错: {str(e)}")
+                continue
+            writer.submit(report, content)
+
+    def _generate_reports_serial(self, reports, prototype, output_dir):
+        """在当前进程中生成报告（渲染在当前线程，保存在后台线程），返回成功生成报告的学生列表"""
+        def save(report, content):
+            with timings.stage('个人报告/写入文件'):
+                with open(os.path.join(output_dir, report_filename(report.student_name)), 'wb') as f:
+                    f.write(content)
+
+        with ReportWriter(save, self._log_report_summary, self.pipeline_queue_size) as writer:
+            self._render_reports(reports, prototype, writer)
+        return writer.succeeded
+
+    def _generate_reports_parallel(self, reports, prototype, output_dir, jobs):
+        """使用多个进程并行渲染和保存已提取好内容的报告，返回成功生成报告的学生列表"""
+        chunks = report_chunks(reports, jobs)
+        logger.info(f"使用 {jobs} 个进程并行生成报告，共 {len(chunks)} 个任务")
+
+        # 工作进程只需要模板原型（直接使用当前进程已解析的原型），不需要成绩数据
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_report_worker,
+                                 initargs=(prototype, output_dir, logger.level,
+                                           self.engine, self.semesters, self.percentiles)) as executor:
+            futures = {executor.submit(_run_report_worker, chunk): [report.student_name for report in chunk]
+                       for chunk in chunks}
+            return collect_report_results(futures)
+
+
+def report_chunks(students, jobs):
+    """把学生（或学生报告）分成多批交给工作进程，每个任务处理一批学生，减少进程间通信次数"""
+    chunk_size = max(1, min(50, len(students) // (jobs * 4)))
+    return [students[i:i + chunk_size] for i in range(0, len(students), chunk_size)]
+
+
+def collect_report_results(futures):
+    """收集工作进程的结果 {future: 这批学生}，返回成功生成报告的学生列表；
+    工作进程异常退出时，该批学生记为失败，其余任务不受影响"""
+    succeeded = []
+    failed_students = []
+    for future in as_completed(futures):
+        try:
+            results, samples = future.result()
+            timings.merge(samples)
+        except Exception as e:
+            logger.error(f"工作进程处理 {len(futures[future])} 名学生时出错: {str(e)}")
+            results = [(student, False) for student in futures[future]]
+
+        for student, success in results:
+            if success:
+                succeeded.append(student)
+                if len(succeeded) % 10 == 0:
+                    logger.info(f"已生成 {len(succeeded)} 份报告...")
+            else:
+                failed_students.append(student)
+
+    if failed_students:
+        logger.warning(f"{len(failed_students)} 名学生的报告生成失败: {sorted(failed_students)}")
+    return succeeded
+
+
+# 并行生成报告时每个工作进程持有的状态
+_worker_state = {}
+
+
+def _init_report_worker(prototype, output_dir, log_level=logging.INFO, engine='openpyxl',
+                        semesters=None, percentiles=False):
+    """工作进程初始化：接收主进程的模板原型。报告内容由主进程提取后随任务传入，工作进程不需要成绩数据"""
+    setup_logging(log_level)
+    # fork方式启动的进程会继承主进程已记录的耗时，先清空，只交回本进程的耗时
+    timings.drain()
+    generator = GradeSummaryGenerator(GradeLoader(semesters), engine=engine, percentiles=percentiles)
+    _worker_state.update(generator=generator, prototype=prototype, output_dir=output_dir)
+
+
+def _run_report_worker(reports):
+    """在工作进程中渲染并保存一批已提取好内容的学生报告，单个学生出错不影响其他学生；
+    返回每名学生是否成功，以及这批学生各阶段的耗时"""
+    generator = _worker_state['generator']
+    results = []
+    for report in reports:
+        try:
+            success = generator.save_student_report(report, _worker_state['prototype'], _worker_state['output_dir'])
+        except Exception as e:
+            logger.error(f"生成 {report.student_name} 的报告时出错: {str(e)}")
+            success = False
+        results.append((report.student_name, success))
+    return results, timings.drain()
+
+
+def _init_batch_worker(log_level, semesters, engine, percentiles=False):
+    """全校批量处理共用进程池的工作进程初始化。工作进程只解析成绩文件（结果交回主进程）和渲染、保存报告，
+    不加载成绩数据，也不读写解析缓存；只输出警告和错误，进度由主进程输出"""
+    setup_logging(max(log_level, logging.WARNING))
+    timings.drain()
+    generator = GradeSummaryGenerator(GradeLoader(semesters), engine=engine, percentiles=percentiles)
+    _worker_state.update(generator=generator, prototype=None)
+
+
+def _run_batch_worker(prototype, output_dir, reports):
+    """在共用进程池中渲染并保存某个成绩目录的一批学生报告（内容和模板原型都来自主进程）；
+    模板未变化时沿用本进程已有的原型，由它生成的XML模板也随之复用"""
+    current = _worker_state.get('prototype')
+    if current is None or current.digest != prototype.digest:
+        _worker_state['prototype'] = prototype
+    _worker_state['output_dir'] = output_dir
+    return _run_report_worker(reports)
+
+
+def named_style(wb, name, **styles):
+    """在工作簿中注册命名样式并返回样式名，已注册时直接使用。styles（font、border、alignment、fill等）以外的属性
+    取工作簿的默认格式，所以没有样式的单元格套用后与逐项设置styles的结果相同"""
+    if name not in wb.named_styles:
+        default = Cell(wb.active)
+        attributes = {attr: copy.copy(getattr(default, attr))
+                      for attr in ('font', 'fill', 'border', 'alignment', 'protection')}
+        attributes['number_format'] = default.number_format
+        attributes.update(styles)
+        wb.add_named_style(NamedStyle(name=name, **attributes))
+    return name
+
+
+def set_cell_styles(cells, style_name, styles):
+    """给一批单元格设置相同的样式属性styles（{font、border、alignment、fill等: 值}）。
+    没有样式的单元格直接套用由这些属性组成的命名样式style_name（一次赋值，比逐项设置快得多），
+    模板中已有样式的单元格逐项设置，保留其余的格式"""
+    for cell in cells:
+        if cell.has_style:
+            for name, value in styles.items():
+                setattr(cell, name, value)
+        else:
+            cell.style = style_name
+
 
 class GradeBefore200:
-    def __init__(self):
+    def __init__(self, loader=None):
+        # 成绩文件加载器，可与GradeSummaryGenerator共用以避免重复解析
+        self.loader = loader or GradeLoader()
+
         # 样式定义
         self.header_fill = PatternFill(start_color="FFD966", end_color="FFD966", fill_type="solid")
         self.header_font = Font(bold=True, color="000000")
@@ -544,9 +2517,8 @@ class GradeBefore200:
         )
         self.center_alignment = Alignment(horizontal='center', vertical='center')
         
-        # 定义9个学期
-        self.semesters = ['初一上期中', '初一上期末', '初一下期中', '初一下期末', 
-                         '初二上期中', '初二上期末', '初二下期中', '初二下期末', '初三上期中']
+        # 学期表与加载器相同，每个学期占一列
+        self.semesters = self.loader.semesters
     
     def create_template_file(self, template_path):
         """创建前200名统计模板文件"""
@@ -570,262 +2542,746 @@ class GradeBefore200:
             
             # 保存模板文件
             wb.save(template_path)
-            print(f"已创建新的模板文件: {template_path}")
+            logger.info(f"已创建新的模板文件: {template_path}")
             return True
         except Exception as e:
-            print(f"创建模板文件时出错: {str(e)}")
+            logger.error(f"创建模板文件时出错: {str(e)}")
             return False
     
     def load_all_grades(self, data_dir):
-        """加载所有成绩文件（复用GradeSummaryGenerator的加载逻辑）"""
-        all_files = []
-        all_files.extend(glob.glob(os.path.join(data_dir, "*.xlsx")))
-        all_files.extend(glob.glob(os.path.join(data_dir, "*.xls")))
-        
-        all_data = {}
-        
-        for file in all_files:
-            try:
-                filename = os.path.basename(file)
-                grade = None
-                semester = None
-                exam_type = None
-                
-                # 匹配学期
-                matched = False
-                for key in self.semesters:
-                    if key in filename:
-                        grade = key[:2]
-                        semester = key[2:3]
-                        exam_type = key[3:]
-                        matched = True
-                        break
-                
-                if not matched:
-                    if "初一" in filename:
-                        grade = "初一"
-                    elif "初二" in filename:
-                        grade = "初二"
-                    elif "初三" in filename:
-                        grade = "初三"
-                    
-                    if "上" in filename:
-                        semester = "上"
-                    elif "下" in filename:
-                        semester = "下"
-                    
-                    if "期中" in filename:
-                        exam_type = "期中"
-                    elif "期末" in filename:
-                        exam_type = "期末"
-                
-                if not grade or not semester or not exam_type:
-                    print(f"无法从文件名 {filename} 中提取完整信息，跳过此文件")
-                    continue
-                
-                key = f"{grade}{semester}{exam_type}"
-                
-                try:
-                    df = pd.read_excel(file)
-                    all_data[key] = df
-                    print(f"成功加载: {key} - {filename}")
-                except Exception as e:
-                    print(f"加载文件 {file} 时出错: {str(e)}")
-            except Exception as e:
-                print(f"处理文件 {file} 时出错: {str(e)}")
-        
-        return all_data
+        """加载所有成绩文件（与GradeSummaryGenerator共用同一个加载器）"""
+        return self.loader.load_all_grades(data_dir)
     
-    def find_school_rank_column(self, df):
-        """查找校排名列"""
-        rank_columns = ['校排名', '校名次', '序号', '校次', '名次']
-        for col in df.columns:
-            col_str = str(col).strip()
-            for rank_col in rank_columns:
-                if rank_col in col_str:
-                    return col
-        return None
-    
-    def find_student_name_column(self, df):
-        """查找学生姓名列"""
-        name_columns = ['姓名', '名字', '学生姓名', '学生名字']
-        for col in df.columns:
-            col_str = str(col).strip()
-            for name_col in name_columns:
-                if name_col in col_str:
-                    return col
-        return None
-    
-    def get_top_200_students(self, df):
-        """获取前200名学生（校排名<=200）"""
-        rank_col = self.find_school_rank_column(df)
-        name_col = self.find_student_name_column(df)
-        
-        if not rank_col or not name_col:
-            print(f"未找到排名列或姓名列，跳过此文件")
-            return []
-        
+    def get_top_students(self, store, semester, thresholds):
+        """从成绩库中获取某学期各档次的学生（校排名不超过各阈值），返回 {阈值: [学生...]}，按排名排序"""
+        if not store.schemas[semester].school_rank_columns:
+            logger.warning(f"{semester} 中未找到校排名列，跳过此文件")
+            return {threshold: [] for threshold in thresholds}
+
         try:
-            # 过滤出校排名<=200的学生
-            df_filtered = df[pd.to_numeric(df[rank_col], errors='coerce') <= 200]
-            
-            # 按排名排序
-            df_sorted = df_filtered.sort_values(by=rank_col, ascending=True)
-            
-            # 提取学生姓名
-            top_students = df_sorted[name_col].dropna().astype(str).tolist()
-            
-            return top_students
+            return store.semester_tiers(semester, thresholds)
         except Exception as e:
-            print(f"获取前200名学生时出错: {str(e)}")
-            return []
+            logger.error(f"获取前{max(thresholds)}名学生时出错: {str(e)}")
+            return {threshold: [] for threshold in thresholds}
+
+    def get_top_200_students(self, store, semester):
+        """从成绩库中获取某学期的前200名学生（校排名<=200），按排名排序"""
+        return self.get_top_students(store, semester, [200])[200]
     
     def safe_write_cell(self, ws, row, col, value):
         """安全地写入单元格，处理合并单元格的情况"""
         try:
-            target_cell = ws.cell(row=row, column=col)
-            # 检查是否是合并单元格
-            for merged_cell in ws.merged_cells.ranges:
-                if target_cell.coordinate in merged_cell:
-                    # 如果是合并单元格，写入左上角单元格
-                    ws[merged_cell.start_cell.coordinate] = value
-                    return True
-            # 不是合并单元格，直接写入
-            target_cell.value = value
+            # 如果是合并单元格，写入左上角单元格
+            row, col = get_merged_cell_index(ws).resolve(row, col)
+            ws.cell(row=row, column=col).value = value
             return True
         except Exception as e:
-            print(f"写入单元格({row}, {col})时出错: {str(e)}")
+            logger.error(f"写入单元格({row}, {col})时出错: {str(e)}")
             return False
     
+    def named_styles(self, wb):
+        """前N名工作表各区域的样式，{区域: (命名样式名, 样式属性)}，命名样式在每个工作簿中注册一次"""
+        regions = {
+            '学期': dict(font=self.header_font, border=self.border, alignment=self.center_alignment,
+                       fill=self.header_fill),
+            '人数': dict(font=self.header_font, border=self.border, alignment=self.center_alignment),
+            '学生姓名': dict(border=self.border, alignment=self.center_alignment),
+        }
+        return {region: (named_style(wb, f"前N名{region}", **styles), styles) for region, styles in regions.items()}
+
     def apply_styles(self, ws):
         """应用样式到工作表"""
-        # 设置标题行样式（第2行和第3行）
-        for row in [2, 3]:
-            for col in range(2, 12):  # B列到K列
-                cell = ws.cell(row=row, column=col)
-                cell.font = self.header_font
-                cell.border = self.border
-                cell.alignment = self.center_alignment
-                if row == 2:  # 第2行添加黄色填充
-                    cell.fill = self.header_fill
+        # 设置标题行样式（第2行和第3行），第2行添加黄色填充
+        # 默认B列到K列，学期表超过9个学期时扩展到最后一个学期所在的列
+        columns = range(2, max(12, len(self.semesters) + 2))
+        styles = self.named_styles(ws.parent)
+        set_cell_styles([ws.cell(row=2, column=col) for col in columns], *styles['学期'])
+        set_cell_styles([ws.cell(row=3, column=col) for col in columns], *styles['人数'])
         
         # 设置学生姓名区域样式（从第4行开始）
         max_row = ws.max_row
-        for row in range(4, max_row + 1):
-            for col in range(2, 12):  # B列到K列
-                cell = ws.cell(row=row, column=col)
+        set_cell_styles([ws.cell(row=row, column=col) for row in range(4, max_row + 1) for col in columns],
+                        *styles['学生姓名'])
+    
+    def write_membership_sheet(self, wb, store, max_rank):
+        """添加前N名变化统计工作表：每学期的人数、新进入和退出人数，以及每名上过榜的学生在各学期的名次、
+        上榜次数、连续上榜次数和进出次数"""
+        summary, by_semester = store.top_membership(max_rank)
+        semesters = list(by_semester.columns)
+        ws = wb.create_sheet(f"前{max_rank}名变化")
+
+        ws.append([f"前{max_rank}名变化统计（缺考视为不在前{max_rank}名）"])
+        ws.append(['学期'] + semesters)
+        for label, counts in by_semester.iterrows():
+            ws.append([label] + [int(count) for count in counts])
+        ws.append([])
+
+        columns = ['上榜次数', '最长连续', '当前连续', '进入次数', '退出次数']
+        header_row = ws.max_row + 1
+        ws.append(['学生姓名'] + semesters + columns + ['每次都在'])
+        ranks = summary[semesters].to_numpy()
+        counts = summary[columns].to_numpy()
+        always = summary['每次都在'].to_numpy()
+        for i, student in enumerate(summary['student']):
+            ws.append([student]
+                      + [None if np.isnan(rank) else int(rank) for rank in ranks[i]]
+                      + [int(count) for count in counts[i]]
+                      + ['是' if always[i] else '否'])
+
+        for row in (2, header_row):
+            for cell in ws[row]:
+                cell.font = self.header_font
                 cell.border = self.border
                 cell.alignment = self.center_alignment
-    
-    def generate_top200_report(self, data_dir, template_path, output_path):
-        """生成前200名统计报告"""
+        logger.info(f"前{max_rank}名变化统计: {len(summary)} 名学生上过榜，"
+                    f"其中 {int(always.sum())} 名每次都在前{max_rank}名")
+        return ws
+
+    def _prepare_tier_sheets(self, wb, ws, thresholds):
+        """为每个档次准备一个工作表，返回 {阈值: 工作表}；只有一个档次时直接使用模板工作表"""
+        if len(thresholds) == 1:
+            return {thresholds[0]: ws}
+        # 先复制出其他档次的工作表，再填充数据
+        sheets = {thresholds[0]: ws}
+        for threshold in thresholds[1:]:
+            sheets[threshold] = wb.copy_worksheet(ws)
+        for threshold, sheet in sheets.items():
+            sheet.title = f"前{threshold}名"
+        return sheets
+
+    def build_top200_workbook(self, all_data, template_path, thresholds=(200,)):
+        """用已加载的成绩数据填充前N名统计工作簿并返回，模板无法加载或创建时返回None"""
+        thresholds = sorted(set(thresholds)) or [200]
+
+        # 检查模板文件是否存在且有效
+        if not os.path.exists(template_path):
+            logger.warning(f"模板文件 '{template_path}' 不存在，尝试创建新模板...")
+            if not self.create_template_file(template_path):
+                logger.error("创建模板文件失败，无法生成报告")
+                return None
+        
+        # 尝试加载模板
         try:
-            # 检查模板文件是否存在且有效
-            if not os.path.exists(template_path):
-                print(f"模板文件 '{template_path}' 不存在，尝试创建新模板...")
-                if not self.create_template_file(template_path):
-                    print("创建模板文件失败，无法生成报告")
-                    return False
-            
-            # 尝试加载模板
-            try:
-                wb = load_workbook(template_path)
-                ws = wb.active
-                print(f"成功加载模板文件: {template_path}")
-            except Exception as e:
-                print(f"加载模板文件 '{template_path}' 时出错: {str(e)}")
-                print("尝试创建新的模板文件...")
-                if not self.create_template_file(template_path):
-                    print("创建模板文件失败，无法生成报告")
-                    return False
-                # 重新加载新创建的模板
+            with timings.stage('前N名报告/加载模板'):
                 wb = load_workbook(template_path)
-                ws = wb.active
-            
-            # 加载成绩数据
-            all_data = self.load_all_grades(data_dir)
-            
-            if not all_data:
-                print("未找到任何成绩文件!")
-                return False
-            
-            print(f"成功加载 {len(all_data)} 个学期的数据")
-            
-            # 填充学期名称（B2往右）
+            ws = wb.active
+            logger.info(f"成功加载模板文件: {template_path}")
+        except Exception as e:
+            logger.warning(f"加载模板文件 '{template_path}' 时出错: {str(e)}")
+            logger.warning("尝试创建新的模板文件...")
+            if not self.create_template_file(template_path):
+                logger.error("创建模板文件失败，无法生成报告")
+                return None
+            # 重新加载新创建的模板
+            wb = load_workbook(template_path)
+            ws = wb.active
+        
+        store = self.loader.get_store(all_data)
+        sheets = self._prepare_tier_sheets(wb, ws, thresholds)
+        
+        # 填充学期名称（B2往右）
+        for sheet in sheets.values():
             for i, semester in enumerate(self.semesters):
                 col = 2 + i  # B列开始，依次向右
-                self.safe_write_cell(ws, 2, col, semester)
-                print(f"填充学期名称: {semester} -> 单元格(2, {col})")
+                self.safe_write_cell(sheet, 2, col, semester)
+                logger.debug("填充学期名称: %s -> 单元格(2, %d)", semester, col)
+        
+        # 统计每个学期各档次的学生并填充，所有档次由一次筛选得到
+        for i, semester in enumerate(self.semesters):
+            col = 2 + i  # B列开始，依次向右
             
-            # 统计每个学期的前200名学生并填充
-            for i, semester in enumerate(self.semesters):
-                col = 2 + i  # B列开始，依次向右
-                
-                if semester not in all_data:
-                    print(f"警告: 未找到 {semester} 的数据")
-                    # 填充人数为0
-                    self.safe_write_cell(ws, 3, col, 0)
-                    continue
-                
-                df = all_data[semester]
-                top_students = self.get_top_200_students(df)
-                
+            if semester not in all_data:
+                logger.warning(f"警告: 未找到 {semester} 的数据")
+                # 填充人数为0
+                for sheet in sheets.values():
+                    self.safe_write_cell(sheet, 3, col, 0)
+                continue
+            
+            with timings.stage('前N名报告/筛选学生'):
+                tiers = self.get_top_students(store, semester, thresholds)
+            for threshold, sheet in sheets.items():
+                top_students = tiers[threshold]
+                label = f"前{threshold}名 " if len(sheets) > 1 else ""
+
                 # 填充人数（B3往右）
-                self.safe_write_cell(ws, 3, col, len(top_students))
-                print(f"填充人数: {semester} -> {len(top_students)}人 -> 单元格(3, {col})")
+                self.safe_write_cell(sheet, 3, col, len(top_students))
+                logger.info(f"填充人数: {label}{semester} -> {len(top_students)}人 -> 单元格(3, {col})")
                 
                 # 填充学生姓名（从B4开始往下）
                 for j, student_name in enumerate(top_students):
                     row = 4 + j  # 从第4行开始
-                    self.safe_write_cell(ws, row, col, student_name)
+                    self.safe_write_cell(sheet, row, col, student_name)
                     if j < 5:  # 只打印前5个学生的填充信息，避免输出过多
-                        print(f"填充学生姓名: {student_name} -> 单元格({row}, {col})")
+                        logger.debug("填充学生姓名: %s -> 单元格(%d, %d)", student_name, row, col)
                 
                 if len(top_students) > 5:
-                    print(f"... 共填充 {len(top_students)} 名学生")
+                    logger.debug("... 共填充 %d 名学生", len(top_students))
+        
+        # 应用样式
+        with timings.stage('前N名报告/应用样式'):
+            for sheet in sheets.values():
+                self.apply_styles(sheet)
+
+        # 跨学期的前N名变化统计（使用最大的档次）
+        with timings.stage('前N名报告/变化统计'):
+            self.write_membership_sheet(wb, store, thresholds[-1])
+        return wb
+
+    def generate_top200_report(self, data_dir, template_path, output_path, thresholds=(200,)):
+        """生成前N名统计报告，thresholds为多个名次时每个档次一个工作表（如前50名、前100名……）"""
+        with timings.stage('前N名报告'):
+            return self._generate_top200_report(data_dir, template_path, output_path, thresholds)
+
+    def _generate_top200_report(self, data_dir, template_path, output_path, thresholds):
+        try:
+            thresholds = sorted(set(thresholds)) or [200]
+
+            # 加载成绩数据
+            all_data = self.load_all_grades(data_dir)
             
-            # 应用样式
-            self.apply_styles(ws)
+            if not all_data:
+                logger.error("未找到任何成绩文件!")
+                return False
             
+            logger.info(f"成功加载 {len(all_data)} 个学期的数据")
+            wb = self.build_top200_workbook(all_data, template_path, thresholds)
+            if wb is None:
+                return False
+
             # 保存文件
-            wb.save(output_path)
-            print(f"前200名统计报告已生成: {output_path}")
+            with timings.stage('前N名报告/保存'):
+                wb.save(output_path)
+            logger.info(f"前{'/'.join(map(str, thresholds))}名统计报告已生成: {output_path}")
             return True
             
         except Exception as e:
-            print(f"生成前200名统计报告时出错: {str(e)}")
+            logger.error(f"生成前{max(thresholds)}名统计报告时出错: {str(e)}")
             return False
 
-# 使用示例
-if __name__ == "__main__":
+# 默认路径
+DATA_DIRECTORY = "./Grade/"  # 存放8个成绩文件的目录
+TEMPLATE_FILE = "成绩模板.xlsx"  # Excel模板文件
+OUTPUT_DIRECTORY = "学生成绩报告"  # 输出目录
+TOP200_TEMPLATE = "前200名.xlsx"  # 前200名模板文件
+TOP200_OUTPUT = "全校前200名统计.xlsx"  # 前200名统计输出文件
+BATCH_OUTPUT_DIRECTORY = "全校成绩报告"  # 全校批量处理的输出目录
+STATISTICS_OUTPUT = "年级成绩统计.xlsx"  # 成绩统计输出文件
+
+SERVE_TIMING_SAMPLES = 1000  # 报告服务每个阶段保留的最近耗时记录数
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def generate_statistics_report(loader, data_dir, output_path, all_data=None):
+    """生成年级成绩统计工作簿（见CohortStatistics），已加载成绩数据时直接使用all_data；成功时返回True"""
+    if all_data is None:
+        all_data = loader.load_all_grades(data_dir)
+    if not all_data:
+        logger.error("未找到任何成绩数据，无法生成成绩统计!")
+        return False
+    statistics = loader.get_statistics(all_data)
+    try:
+        with timings.stage('成绩统计/保存'):
+            statistics.save(output_path)
+    except Exception as e:
+        logger.error(f"保存成绩统计 {output_path} 时出错: {str(e)}")
+        return False
+    logger.info(f"成绩统计已生成: {output_path}")
+    return True
+
+
+def ensure_top200_template(top200_generator, template_path):
+    """检查前200名模板文件是否存在，如果不存在则创建新模板"""
+    if not os.path.exists(template_path):
+        logger.info(f"前200名模板文件 '{template_path}' 不存在，将创建新模板")
+        top200_generator.create_template_file(template_path)
+
+
+class ReportService:
+    """常驻内存的报告服务：成绩数据、成绩库和模板原型加载一次后一直保留，按需生成单个学生的报告或前N名统计。
+    每次请求前检查成绩目录和模板文件，只有文件新增、删除或修改时才重新加载（未修改的文件直接使用内存中的结果）"""
+
+    def __init__(self, data_dir=DATA_DIRECTORY, template_path=TEMPLATE_FILE, top200_template=TOP200_TEMPLATE,
+                 engine='xml', thresholds=(200,), loader=None, percentiles=False):
+        self.data_dir = data_dir
+        self.template_path = template_path
+        self.top200_template = top200_template
+        self.thresholds = sorted(set(thresholds))
+        self.loader = loader or GradeLoader()
+        self.generator = GradeSummaryGenerator(loader=self.loader, engine=engine, percentiles=percentiles)
+        self.top200_generator = GradeBefore200(loader=self.loader)
+
+        self.all_data = {}
+        self.store = None
+        self.prototype = None
+        self.loaded_at = None
+        # 成绩目录和模板文件的状态，与上次加载时不同时重新加载
+        self._signature = None
+        # 前N名统计在数据不变时内容相同，{档次: 文件内容}
+        self._top200_content = {}
+        self._lock = threading.Lock()
+
+    def _source_signature(self):
+        """成绩文件和模板文件的 (路径, 大小, 修改时间)"""
+        signature = []
+        for path in sorted(self.loader.list_files(self.data_dir)) + [self.template_path, self.top200_template]:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def refresh(self):
+        """文件有变化时重新加载成绩数据、成绩库和模板原型，返回是否重新加载"""
+        with self._lock:
+            signature = self._source_signature()
+            if signature == self._signature:
+                return False
+
+            start_time = time.perf_counter()
+            ensure_top200_template(self.top200_generator, self.top200_template)
+            all_data = self.loader.load_all_grades(self.data_dir)
+            if all_data:
+                self.store = self.generator.get_grade_store(all_data)
+                self.prototype = self.generator.get_template_prototype(self.template_path)
+                if self.generator.engine == 'xml':
+                    self.generator.get_xml_template(self.prototype)
+            else:
+                logger.error("未找到任何成绩文件!")
+                self.store = None
+            self.all_data = all_data
+            self._top200_content.clear()
+            # 重新取一次状态，加载期间创建的模板也计入
+            self._signature = self._source_signature()
+            self.loaded_at = time.time()
+            seconds = time.perf_counter() - start_time
+            timings.record('服务/重新加载', seconds)
+            logger.info(f"报告服务已加载 {len(all_data)} 个学期的数据（耗时 {seconds:.2f}秒）")
+            return True
+
+    def students(self):
+        """所有学生姓名"""
+        self.refresh()
+        return list(self.store.students) if self.store else []
+
+    def student_report(self, student):
+        """生成单个学生的报告，返回 (文件名, .xlsx文件内容)；没有该学生时返回None"""
+        self.refresh()
+        if self.store is None or student not in self.store.student_codes:
+            return None
+        report = self.generator.build_student_cells(student, self.all_data, self.prototype.template_subjects)
+        return report_filename(student), self.generator.render_student_report_bytes(report, self.prototype)
+
+    def top200_report(self, thresholds=None):
+        """生成前N名统计，返回 (文件名, .xlsx文件内容)；没有成绩数据或模板无法使用时返回None"""
+        self.refresh()
+        if not self.all_data:
+            return None
+        thresholds = tuple(sorted(set(thresholds or self.thresholds)))
+        content = self._top200_content.get(thresholds)
+        if content is None:
+            wb = self.top200_generator.build_top200_workbook(self.all_data, self.top200_template, thresholds)
+            if wb is None:
+                return None
+            buffer = io.BytesIO()
+            wb.save(buffer)
+            content = self._top200_content[thresholds] = buffer.getvalue()
+        return os.path.basename(TOP200_OUTPUT), content
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """报告服务的HTTP接口：
+    GET /students              所有学生姓名（JSON）
+    GET /report/<姓名>          该学生的 <姓名>_成绩总结.xlsx
+    GET /top200[?n=50&n=100]   前N名统计.xlsx，n为名次档次，默认使用启动时的--top-n"""
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path).rstrip('/') or '/'
+        service = self.server.service
+        stage = '其他'
+        try:
+            if path in ('/', '/students'):
+                stage = '学生列表'
+                body = json.dumps({'students': service.students(),
+                                   'loaded_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(service.loaded_at))},
+                                  ensure_ascii=False).encode('utf-8')
+                status = self._send(200, body, 'application/json; charset=utf-8')
+            elif path.startswith('/report/'):
+                stage = '个人报告'
+                student = path[len('/report/'):].strip()
+                result = service.student_report(student)
+                if result is None:
+                    status = self._send_text(404, f"未找到学生: {student}")
+                else:
+                    status = self._send(200, result[1], XLSX_CONTENT_TYPE, result[0])
+            elif path == '/top200':
+                stage = '前N名报告'
+                thresholds = self._parse_thresholds(url.query)
+                if thresholds is None:
+                    status = self._send_text(400, "名次档次n必须是正整数")
+                else:
+                    result = service.top200_report(thresholds)
+                    if result is None:
+                        status = self._send_text(503, "无法生成前N名统计，请检查成绩文件和模板")
+                    else:
+                        status = self._send(200, result[1], XLSX_CONTENT_TYPE, result[0])
+            else:
+                status = self._send_text(404, "可用的地址: /students, /report/<姓名>, /top200?n=200")
+        except Exception as e:
+            logger.error(f"处理请求 {path} 时出错: {str(e)}")
+            status = self._send_text(500, f"生成报告时出错: {str(e)}")
+
+        seconds = time.perf_counter() - start_time
+        timings.record(f'服务/{stage}', seconds)
+        logger.info(f"{self.command} {path} -> {status}（{seconds * 1000:.1f}毫秒）")
+
+    @staticmethod
+    def _parse_thresholds(query):
+        """解析查询参数中的名次档次n，有不是正整数的值时返回None"""
+        try:
+            thresholds = [int(n) for n in urllib.parse.parse_qs(query).get('n', [])]
+        except ValueError:
+            return None
+        return thresholds if all(n > 0 for n in thresholds) else None
+
+    def _send(self, status, body, content_type, filename=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if filename:
+            # 文件名含中文，按RFC 5987编码
+            self.send_header('Content-Disposition',
+                             f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}")
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def _send_text(self, status, message):
+        return self._send(status, message.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def log_message(self, format, *args):
+        """请求日志由do_GET通过logger输出"""
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    """启动报告服务，按Ctrl+C停止。请求逐个处理，共用内存中的成绩数据"""
+    # 服务长期运行，每个请求都会记录耗时，只保留最近的记录，避免耗时统计无限增长
+    timings.limit(SERVE_TIMING_SAMPLES)
+    service.refresh()
+    server = HTTPServer((host, port), ReportRequestHandler)
+    server.service = service
+    logger.info(f"报告服务已启动: http://{host}:{port}/（/students、/report/<姓名>、/top200），按Ctrl+C停止")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("报告服务已停止")
+    finally:
+        server.server_close()
+
+
+class SchoolBatch:
+    """全校批量处理：找出目录树中所有年级/班级的成绩目录（含有能识别学期的成绩文件的目录），
+    所有成绩目录的文件解析和个人报告生成共用一个进程池，一次运行处理全校。
+    每个成绩目录的结果保存在输出目录下相同的相对路径中（学生成绩报告/、全校前200名统计.xlsx 和 年级成绩统计.xlsx）"""
+
+    def __init__(self, root, output_root=BATCH_OUTPUT_DIRECTORY, template_path=TEMPLATE_FILE,
+                 top200_template=TOP200_TEMPLATE, semesters=None, jobs=1, engine='openpyxl', incremental=True,
+                 output_mode='files', thresholds=(200,), reader='auto', use_cache=True, derive_ranks=False,
+                 rank_method='min', statistics=False, percentiles=False, full_marks=None):
+        self.root = root
+        self.output_root = output_root
+        self.template_path = template_path
+        self.top200_template = top200_template
+        self.jobs = jobs if jobs and jobs > 0 else (os.cpu_count() or 1)
+        self.incremental = incremental
+        self.output_mode = output_mode
+        self.thresholds = sorted(set(thresholds))
+        # 是否为每个成绩目录生成成绩统计工作簿
+        self.statistics = statistics
+        self.loader = GradeLoader(semesters, use_cache=use_cache, reader=reader, derive_ranks=derive_ranks,
+                                  rank_method=rank_method, full_marks=full_marks)
+        self.generator = GradeSummaryGenerator(loader=self.loader, engine=engine, percentiles=percentiles)
+        self.top200_generator = GradeBefore200(loader=self.loader)
+
+    def find_cohorts(self):
+        """目录树中所有含有成绩文件的目录，按路径排序；跳过隐藏目录（如解析缓存）和输出目录"""
+        output_root = os.path.abspath(self.output_root)
+        cohorts = []
+        for dirpath, dirnames, _ in os.walk(self.root):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.')
+                                 and os.path.abspath(os.path.join(dirpath, name)) != output_root)
+            if self.loader.semester_files(dirpath, warn=False):
+                cohorts.append(dirpath)
+        return sorted(cohorts)
+
+    def cohort_name(self, cohort_dir):
+        return os.path.relpath(cohort_dir, self.root)
+
+    def cohort_outputs(self, cohort_dir):
+        """成绩目录对应的 (个人报告输出目录, 前N名统计文件, 成绩统计文件)"""
+        base = os.path.normpath(os.path.join(self.output_root, self.cohort_name(cohort_dir)))
+        return (os.path.join(base, OUTPUT_DIRECTORY), os.path.join(base, TOP200_OUTPUT),
+                os.path.join(base, STATISTICS_OUTPUT))
+
+    def run(self):
+        """处理所有成绩目录，返回 {成绩目录: 成功生成的个人报告数}"""
+        cohorts = self.find_cohorts()
+        if not cohorts:
+            logger.error(f"{self.root} 中未找到任何成绩文件!")
+            return {}
+        logger.info(f"找到 {len(cohorts)} 个成绩目录: {[self.cohort_name(cohort) for cohort in cohorts]}")
+        ensure_top200_template(self.top200_generator, self.top200_template)
+
+        if self.jobs <= 1:
+            return self._run(cohorts, None)
+        logger.info(f"所有成绩目录共用 {self.jobs} 个工作进程")
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_batch_worker,
+                                 initargs=(logger.level, self.loader.semesters, self.generator.engine,
+                                           self.generator.percentiles)) as executor:
+            return self._run(cohorts, executor)
+
+    def _run(self, cohorts, executor):
+        # 先把所有成绩目录中没有缓存的文件一起交给进程池解析
+        with timings.stage('批量处理/解析成绩文件'):
+            parsed = self.loader.prefetch(cohorts, executor)
+        logger.info(f"解析了 {parsed} 个没有缓存的成绩文件")
+
+        # 依次为每个成绩目录提交个人报告任务，工作进程生成报告的同时在当前进程生成前N名统计
+        started = [(cohort, self._start_cohort(cohort, executor)) for cohort in cohorts]
+        counts = {cohort: finish() for cohort, finish in started}
+        logger.info(f"全校批量处理完成: {len(cohorts)} 个成绩目录，共生成 {sum(counts.values())} 份学生成绩报告，"
+                    f"保存在 {self.output_root} 中")
+        return counts
+
+    def _start_cohort(self, cohort_dir, executor):
+        """处理一个成绩目录：生成前N名统计，并生成（或提交到进程池）个人报告；
+        返回一个函数，调用时等待该目录的个人报告全部完成，返回成功生成的报告数"""
+        name = self.cohort_name(cohort_dir)
+        output_dir, top200_output, statistics_output = self.cohort_outputs(cohort_dir)
+        logger.info(f"===== {name} =====")
+        with timings.stage('批量处理/准备成绩目录'):
+            os.makedirs(output_dir if self.output_mode == 'files' else os.path.dirname(output_dir), exist_ok=True)
+            prepared = self.generator.prepare_reports(cohort_dir, self.template_path)
+        if prepared is None:
+            self.loader.release(cohort_dir)
+            return lambda: 0
+        all_data, all_students, prototype = prepared
+        failed = []
+        reports = self.generator.iter_student_cells(sorted(all_students), all_data, prototype.template_subjects,
+                                                    failed)
+
+        if self.output_mode != 'files':
+            # 打包输出按顺序写入一个文件，在当前进程中生成
+            output_path = output_dir + ('.zip' if self.output_mode == 'zip' else '.xlsx')
+            if self.output_mode == 'zip':
+                count = self.generator.write_report_archive(reports, prototype, output_path)
+            else:
+                count = self.generator.write_report_workbook(reports, prototype, output_path)
+            logger.info(f"{name}: 成功生成 {count} 份学生成绩报告，保存在 {output_path} 中")
+            if failed:
+                logger.warning(f"{name}: {len(failed)} 名学生的报告生成失败: {failed}")
+
+            def finish():
+                return count
+        else:
+            plan = ReportPlan(output_dir, prototype.digest, self.incremental)
+            plan.failed = failed
+            reports = plan.changed(reports)
+            plan.remove_missing(all_students)
+            futures = None
+            if executor is None:
+                plan.finish(self.generator._generate_reports_serial(reports, prototype, output_dir))
+            else:
+                # 报告内容在计算增量哈希时已经提取，工作进程只负责渲染和保存
+                futures = {executor.submit(_run_batch_worker, prototype, output_dir, chunk):
+                           [report.student_name for report in chunk]
+                           for chunk in report_chunks(list(reports), self.jobs)}
+
+            def finish():
+                if futures is not None:
+                    plan.finish(collect_report_results(futures))
+                logger.info(f"{name}: 成功生成 {len(plan.succeeded)} 份学生成绩报告，跳过 {len(plan.skipped)} 份未变化的报告，"
+                            f"删除 {len(plan.removed)} 份已不存在学生的报告")
+                if plan.failed:
+                    logger.warning(f"{name}: {len(plan.failed)} 名学生的报告生成失败: {plan.failed}")
+                return len(plan.succeeded)
+
+        with timings.stage('前N名报告'):
+            wb = self.top200_generator.build_top200_workbook(all_data, self.top200_template, self.thresholds)
+            if wb is not None:
+                wb.save(top200_output)
+                logger.info(f"前{'/'.join(map(str, self.thresholds))}名统计报告已生成: {top200_output}")
+        if self.statistics:
+            generate_statistics_report(self.loader, cohort_dir, statistics_output, all_data)
+
+        # 报告内容已全部提取，当前进程不再需要这个成绩目录的数据
+        self.loader.release(cohort_dir)
+        return finish
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="班级个人成绩总结系统")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="并行生成学生报告的进程数（默认1，即串行；0表示使用全部CPU核心）")
+    parser.add_argument('--force', action='store_true',
+                        help="重新生成所有学生报告（默认只重新生成成绩或模板有变化的报告）")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="不使用成绩目录下的解析缓存，强制重新读取所有Excel文件")
+    parser.add_argument('--reader', choices=['auto'] + list(GRADE_READERS), default='auto',
+                        help="成绩文件的读取方式：auto（默认）安装了python-calamine时使用calamine，否则使用pandas；"
+                             "openpyxl为只读模式流式读取需要的列")
+    parser.add_argument('--load-jobs', type=int, default=0,
+                        help="并发解析成绩文件的进程数（默认0，即按CPU核心数）")
+    parser.add_argument('--engine', choices=GradeSummaryGenerator.engines, default='openpyxl',
+                        help="学生报告的生成方式：openpyxl（默认）或xml（直接替换模板中的单元格，速度更快）")
+    parser.add_argument('--output-mode', choices=GradeSummaryGenerator.output_modes, default='files',
+                        help="学生报告的输出方式：files（默认）每名学生一个文件；zip全部写入一个压缩包；"
+                             "workbook全部写入一个工作簿，每名学生一个工作表。后两种方式每次都完整重新生成")
+    parser.add_argument('--top-n', type=int, nargs='+', default=[200], metavar='N',
+                        help="前N名统计的名次档次，可指定多个，每个档次一个工作表（默认200）")
+    parser.add_argument('--derive-ranks', action='store_true',
+                        help="成绩文件没有校排名/班排名列时按总分计算（班排名需要班级列），并计算各科目的年级名次")
+    parser.add_argument('--rank-ties', choices=list(RANK_METHODS), default='min',
+                        help="计算排名时同分的处理方式（也用于合并分班文件后重新计算排名）: "
+                             + "；".join(f"{name} {text}" for name, text in RANK_METHODS.items()) + "（默认min）")
+    parser.add_argument('--statistics', nargs='?', const=STATISTICS_OUTPUT, metavar='PATH',
+                        help=f"生成成绩统计工作簿（默认 {STATISTICS_OUTPUT}）：每个学期、科目、班级和全年级的参考人数、平均分、"
+                             "中位数、最高/最低分、标准差、及格率和分数段")
+    parser.add_argument('--percentiles', action='store_true',
+                        help="在个人报告中添加各科成绩的年级百分位列（全年级中分数不高于该成绩的人数占比）")
+    parser.add_argument('--full-marks', nargs='+', metavar='科目=分数',
+                        help="成绩统计中各科的满分（及格线为满分的60%%），默认语文、数学、英语120分，其他科目100分，"
+                             "总分为各科满分之和")
+    parser.add_argument('--timings', nargs='?', const='运行耗时.json', metavar='PATH',
+                        help="把各阶段耗时（总计和分位数）写入JSON运行报告（默认 运行耗时.json）；不指定时只在日志中输出")
+    parser.add_argument('--profile', nargs='?', const='运行分析.prof', metavar='PATH',
+                        help="用cProfile分析整个运行过程并把统计结果写入PATH（默认 运行分析.prof），"
+                             "可用 python -m pstats PATH 查看；并行生成时工作进程中的调用不在统计中")
+    parser.add_argument('--semesters', nargs='+', metavar='学期',
+                        help="学期表：完整的学期键（如 初三下期中）或年级（如 初一 初二 初三，每个年级展开为上下学期的期中期末），"
+                             "按顺序排列；默认初一上期中到初三上期中共9个学期")
+    parser.add_argument('--cohorts', metavar='DIR',
+                        help="全校批量处理：处理DIR下所有含有成绩文件的目录（每个年级或班级一个目录），"
+                             "共用-j指定的工作进程")
+    parser.add_argument('--batch-output', default=BATCH_OUTPUT_DIRECTORY, metavar='DIR',
+                        help=f"全校批量处理的输出目录，每个成绩目录的结果保存在其中相同的相对路径下（默认 {BATCH_OUTPUT_DIRECTORY}）")
+    parser.add_argument('--serve', action='store_true',
+                        help="以本地HTTP服务的方式常驻运行，按需返回单个学生的报告或前N名统计，成绩文件变化时自动重新加载")
+    parser.add_argument('--host', default='127.0.0.1', help="--serve时监听的地址（默认127.0.0.1，只允许本机访问）")
+    parser.add_argument('--port', type=int, default=8765, help="--serve时监听的端口（默认8765）")
+    log_group = parser.add_mutually_exclusive_group()
+    log_group.add_argument('--log-level', choices=['debug', 'info', 'warning'], default='info',
+                           help="日志级别：debug输出每个单元格的填充细节，info（默认）每名学生一行摘要，warning只输出警告和错误")
+    log_group.add_argument('-v', '--verbose', dest='log_level', action='store_const', const='debug',
+                           help="等同于 --log-level debug")
+    log_group.add_argument('-q', '--quiet', dest='log_level', action='store_const', const='warning',
+                           help="等同于 --log-level warning")
+    args = parser.parse_args(argv)
+    try:
+        args.full_marks = parse_full_marks(args.full_marks)
+    except ValueError as e:
+        parser.error(str(e))
+    # 与报告服务的 /top200?n= 相同，名次档次必须是正整数
+    if any(n <= 0 for n in args.top_n):
+        parser.error(f"--top-n 的名次档次必须是正整数: {args.top_n}")
+    return args
+
+
+def main(argv=None):
+    """程序入口"""
+    args = parse_args(argv)
+    setup_logging(getattr(logging, args.log_level.upper()))
+
+    task = serve_from_args if args.serve else run_batch if args.cohorts else run
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(task, args)
+        write_profile(profiler, args.profile)
+    else:
+        task(args)
+
+    timings.log_summary()
+    if args.timings:
+        timings.save(args.timings, arguments=vars(args))
+
+
+def write_profile(profiler, path, limit=20):
+    """写入cProfile统计文件，并输出累计耗时最多的函数"""
+    profiler.dump_stats(path)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+    logger.info(f"性能分析结果已写入: {path}（累计耗时最多的 {limit} 个函数如下）")
+    logger.info(output.getvalue().rstrip())
+
+
+def semesters_from_args(args):
+    """命令行指定的学期表，未指定时为None（使用默认的9个学期）"""
+    return parse_semester_schedule(args.semesters) if args.semesters else None
+
+
+def run_batch(args):
+    """按命令行参数进行全校批量处理"""
+    SchoolBatch(args.cohorts, args.batch_output, semesters=semesters_from_args(args), jobs=args.jobs,
+                engine=args.engine, incremental=not args.force, output_mode=args.output_mode,
+                thresholds=args.top_n, reader=args.reader, use_cache=not args.no_cache,
+                derive_ranks=args.derive_ranks, rank_method=args.rank_ties, statistics=bool(args.statistics),
+                percentiles=args.percentiles, full_marks=args.full_marks).run()
+
+
+def loader_from_args(args):
+    """按命令行参数创建成绩文件加载器"""
+    return GradeLoader(semesters_from_args(args), use_cache=not args.no_cache, load_jobs=args.load_jobs,
+                       reader=args.reader, derive_ranks=args.derive_ranks, rank_method=args.rank_ties,
+                       full_marks=args.full_marks)
+
+
+def serve_from_args(args):
+    """按命令行参数启动报告服务"""
+    service = ReportService(engine=args.engine, thresholds=args.top_n, loader=loader_from_args(args),
+                            percentiles=args.percentiles)
+    serve(service, args.host, args.port)
+
+
+def run(args):
+    """按命令行参数生成个人报告和前N名统计报告"""
     # 提示安装xlrd库（如果需要）
     try:
         import xlrd
     except ImportError:
-        print("提示: 检测到未安装xlrd库，将无法读取.xls格式的成绩文件。")
-        print("请运行以下命令安装xlrd库：")
-        print("pip install xlrd")
-        print("\n如果您只需要处理.xlsx格式的文件，可以忽略此提示。")
-        print("")
+        logger.warning("提示: 检测到未安装xlrd库，将无法读取.xls格式的成绩文件。")
+        logger.warning("请运行以下命令安装xlrd库：")
+        logger.warning("pip install xlrd")
+        logger.warning("如果您只需要处理.xlsx格式的文件，可以忽略此提示。")
     
-    generator = GradeSummaryGenerator()
+    # 两个生成器共用同一个加载器，每个成绩文件在一次运行中只解析一次
+    loader = loader_from_args(args)
+    generator = GradeSummaryGenerator(loader=loader, engine=args.engine, percentiles=args.percentiles)
     
     # 设置路径
-    data_directory = "./Grade/"  # 存放8个成绩文件的目录
-    template_file = "成绩模板.xlsx"  # Excel模板文件
-    output_directory = "学生成绩报告"  # 输出目录
+    data_directory = DATA_DIRECTORY
+    template_file = TEMPLATE_FILE
+    output_directory = OUTPUT_DIRECTORY
     
     # 生成所有报告
-    generator.generate_all_reports(data_directory, template_file, output_directory)
+    generator.generate_all_reports(data_directory, template_file, output_directory, jobs=args.jobs,
+                                   incremental=not args.force, output_mode=args.output_mode)
     
     # 新增：生成前200名统计报告
-    top200_generator = GradeBefore200()
-    top200_template = "前200名.xlsx"  # 前200名模板文件
-    top200_output = "全校前200名统计.xlsx"  # 前200名统计输出文件
+    top200_generator = GradeBefore200(loader=loader)
+    top200_template = TOP200_TEMPLATE
+    top200_output = TOP200_OUTPUT
+    ensure_top200_template(top200_generator, top200_template)
     
-    # 检查模板文件是否存在，如果不存在或损坏则创建新模板
-    if not os.path.exists(top200_template):
-        print(f"前200名模板文件 '{top200_template}' 不存在，将创建新模板")
-        top200_generator.create_template_file(top200_template)
-    
-    top200_generator.generate_top200_report(data_directory, top200_template, top200_output)
\ No newline at end of file
+    top200_generator.generate_top200_report(data_directory, top200_template, top200_output, thresholds=args.top_n)
+
+    # 成绩统计
+    if args.statistics:
+        generate_statistics_report(loader, data_directory, args.statistics)
+
+
+# 使用示例
+if __name__ == "__main__":
+    main()